@@ -0,0 +1,296 @@
+# Batch simulator for balance tuning.
+#
+#   python balance.py --runs 2000
+#   python balance.py --set SWORD_DAMAGE=3 --set ENEMY_STATS.spider.hp=4
+#   python balance.py --sweep SWORD_DAMAGE=1,2,3 --sweep FIREBALL_COOLDOWN_MS=900,1200
+#   python balance.py --bot random --json results.json
+#
+# Plays seeded runs of the headless Simulation across every CPU core and
+# prints, per configuration, the win rate, how long each room took to clear
+# (grouped by room depth), damage taken and food eaten. A configuration is a
+# set of overrides of main's tuning globals (ENEMY_STATS, SWORD_*,
+# FIREBALL_*, PLAYER_*, item_heal, ...); dotted names reach into dicts.
+# --sweep values multiply out into one configuration per combination. The
+# same seeds are used for every configuration so they are compared on the
+# same dungeons.
+import argparse
+import copy
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import main
+
+MAX_SECONDS = 600     # a run still going after this much game time is a timeout
+CHUNK = 25            # runs per task handed to a worker
+
+# ---------------------------------------
+# CONFIGURATIONS
+# ---------------------------------------
+# Tunables are plain module globals read at call time, so a worker can
+# patch them in place. The pristine values are kept so a worker that is
+# handed another configuration starts from the defaults again. ROOM_COUNT
+# is a default argument, so play() passes it explicitly; the settings
+# below are bound into defaults at import and nothing here can pass them,
+# so patching them would silently do nothing.
+defaults = {}
+IMPORT_TIME = {"FIREBALL_POOL_SIZE", "ROTATION_STEPS", "ROTATION_CACHE_SIZE", "PROFILE_WINDOW"}
+
+def parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def apply_config(overrides):
+    for name, value in defaults.items():
+        setattr(main, name, copy.deepcopy(value))
+    for key, value in overrides.items():
+        name, *path = key.split(".")
+        if not hasattr(main, name):
+            raise KeyError(f"main has no setting {name}")
+        if name in IMPORT_TIME:
+            raise KeyError(f"{name} is only read when main is imported")
+        if name not in defaults:
+            defaults[name] = copy.deepcopy(getattr(main, name))
+        if not path:
+            setattr(main, name, value)
+            continue
+        target = getattr(main, name)
+        for p in path[:-1]:
+            target = target[p]
+        target[path[-1]] = value
+
+def config_name(overrides):
+    return " ".join(f"{k}={json.dumps(v)}" for k, v in overrides.items()) or "default"
+
+# ---------------------------------------
+# BOTS
+# ---------------------------------------
+# Both bots only ever see the Simulation and answer with Inputs, the same
+# interface the keyboard loop and replays use.
+
+class RandomBot:
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+
+    def act(self, sim):
+        rng = self.rng
+        attack = None
+        if rng.random() < 0.1:
+            px, py = sim.player.center
+            attack = (px + rng.randint(-80, 80), py + rng.randint(-80, 80))
+        use = ()
+        if sim.player.health <= 4 and rng.random() < 0.05:
+            use = (rng.choice(main.ITEM_ORDER),)
+        return main.Inputs(dx=rng.choice((-1, 0, 1)), dy=rng.choice((-1, 0, 1)),
+                           attack=attack, use=use, open_chests=True)
+
+# Clears every room it walks through: fights the nearest enemy, then loots
+# the chests, then takes the door on the shortest route to the final room.
+# Walking goes through a flow field of its own, like the enemies' chase.
+class ScriptedBot:
+    def __init__(self, seed):
+        self.flow = main.FlowField()
+        self.last = None
+        self.stuck = 0
+        self.rng = random.Random(seed)
+
+    def route(self, sim):
+        dungeon = sim.dungeon
+        prev = {sim.current_room: None}
+        queue = [sim.current_room]
+        for i in queue:
+            for d, n in dungeon.neighbors[i].items():
+                if n is not None and n not in prev:
+                    prev[n] = (i, d)
+                    queue.append(n)
+        i = dungeon.final_room
+        step = None
+        while prev[i] is not None:
+            i, step = prev[i]
+        return step
+
+    def heal(self, sim):
+        p = sim.player
+        for name in main.ITEM_ORDER:
+            if sim.inventory[name] and p.health + main.item_heal[name] <= p.max_health:
+                return (name,)
+        return ()
+
+    def act(self, sim):
+        p = sim.player
+        px, py = p.center
+        _, enemies, chests = sim.room_data[sim.current_room]
+        attack = None
+        flee = False
+        if enemies:
+            e = min(enemies, key=lambda e: (e.center[0]-px)**2 + (e.center[1]-py)**2)
+            tx, ty = e.center
+            d2 = (tx-px)**2 + (ty-py)**2
+            if not p.attacking and d2 <= (main.SWORD_RANGE_PIXELS*0.9)**2:
+                attack = (tx, ty)
+            # hit from the edge of the sword's reach and back off when crowded
+            flee = d2 < (main.SWORD_RANGE_PIXELS*0.5)**2
+        else:
+            closed = [c for c in chests if not c.open]
+            if closed:
+                tx, ty = min((c.rect.center for c in closed),
+                             key=lambda c: (c[0]-px)**2 + (c[1]-py)**2)
+            else:
+                d = self.route(sim)
+                tx, ty = sim.room_doors[sim.current_room][d].center if d else (px, py)
+
+        grid = sim.rooms[sim.current_room]
+        hop = self.flow.update(grid, tx//main.TILE, ty//main.TILE).next_hop(px, py)
+        hx, hy = hop if hop is not None else (tx, ty)
+        dx = (hx > px+1) - (hx < px-1)
+        dy = (hy > py+1) - (hy < py-1)
+        if flee:
+            dx = (px > tx) - (px < tx)
+            dy = (py > ty) - (py < ty)
+
+        # wiggle free when pinned against a pillar corner
+        pos = (p.x, p.y)
+        self.stuck = self.stuck+1 if pos == self.last and (dx or dy) else 0
+        self.last = pos
+        if self.stuck > 10:
+            dx, dy = self.rng.choice(((dx, 0), (0, dy), (-dy, dx), (dy, -dx)))
+
+        return main.Inputs(dx=dx, dy=dy, attack=attack, use=self.heal(sim), open_chests=True)
+
+BOTS = {"scripted": ScriptedBot, "random": RandomBot}
+
+# ---------------------------------------
+# RUNS
+# ---------------------------------------
+def play(seed, bot_name, max_ticks):
+    sim = main.Simulation(seed=seed, room_count=main.ROOM_COUNT)
+    bot = BOTS[bot_name](seed)
+    p = sim.player
+    entered = {0: 0}
+    cleared = {}
+    damage = 0
+    used = dict.fromkeys(main.ITEM_ORDER, 0)
+
+    while sim.state == "play" and sim.frame < max_ticks:
+        inputs = bot.act(sim)
+        health = p.health
+        stock = dict(sim.inventory)
+        sim.step(inputs)
+        damage += max(0, health - p.health)
+        for name in inputs.use:
+            used[name] += stock[name] - sim.inventory[name]
+
+        room = sim.current_room
+        entered.setdefault(room, sim.frame)
+        if room not in cleared and not sim.room_data[room][1]:
+            cleared[room] = sim.frame
+
+    depth = sim.dungeon.depth
+    return {
+        "result": sim.state if sim.state != "play" else "timeout",
+        "ticks": sim.frame,
+        "damage": damage,
+        "used": used,
+        "clear": [(depth[i], cleared[i] - entered[i]) for i in cleared],
+        "rooms": len(entered),
+    }
+
+def play_chunk(overrides, seeds, bot_name, max_ticks):
+    apply_config(overrides)
+    return [play(seed, bot_name, max_ticks) for seed in seeds]
+
+# ---------------------------------------
+# REPORT
+# ---------------------------------------
+def summarize(runs):
+    n = len(runs)
+    wins = [r for r in runs if r["result"] == "win"]
+    by_depth = {}
+    for r in runs:
+        for depth, ticks in r["clear"]:
+            by_depth.setdefault(depth, []).append(ticks / main.TICK_RATE)
+    return {
+        "runs": n,
+        "win_rate": len(wins) / n,
+        "death_rate": sum(r["result"] == "gameover" for r in runs) / n,
+        "timeout_rate": sum(r["result"] == "timeout" for r in runs) / n,
+        "win_seconds": sum(r["ticks"] for r in wins) / main.TICK_RATE / len(wins) if wins else None,
+        "rooms_visited": sum(r["rooms"] for r in runs) / n,
+        "damage_taken": sum(r["damage"] for r in runs) / n,
+        "items_used": {k: sum(r["used"][k] for r in runs) / n for k in main.ITEM_ORDER},
+        "clear_seconds_by_depth": {d: sum(v)/len(v) for d, v in sorted(by_depth.items())},
+    }
+
+def print_summary(name, s):
+    print(f"== {name}")
+    win_time = f"{s['win_seconds']:.1f}s" if s["win_seconds"] is not None else "-"
+    print(f"   runs {s['runs']}  win {s['win_rate']:.1%}  died {s['death_rate']:.1%}  "
+          f"timeout {s['timeout_rate']:.1%}  mean win time {win_time}")
+    print(f"   rooms visited {s['rooms_visited']:.2f}  damage taken {s['damage_taken']:.2f} half-hearts")
+    print("   items used   " + "  ".join(f"{k} {v:.2f}" for k, v in s["items_used"].items()))
+    print("   clear time   " + "  ".join(f"d{d} {t:.1f}s" for d, t in s["clear_seconds_by_depth"].items()))
+
+def build_configs(sets, sweeps):
+    base = {}
+    for item in sets:
+        key, _, value = item.partition("=")
+        base[key] = parse_value(value)
+    axes = []
+    for item in sweeps:
+        key, _, values = item.partition("=")
+        axes.append([(key, parse_value(v)) for v in values.split(",")])
+    return [dict(base, **dict(combo)) for combo in itertools.product(*axes)]
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=500, help="seeded runs per configuration")
+    parser.add_argument("--seed", type=int, default=0, help="first run seed")
+    parser.add_argument("--bot", choices=list(BOTS), default="scripted")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="override a setting in every configuration")
+    parser.add_argument("--sweep", action="append", default=[], metavar="NAME=V1,V2,...",
+                        help="one configuration per value (several sweeps multiply)")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: CPU count)")
+    parser.add_argument("--max-seconds", type=float, default=MAX_SECONDS,
+                        help="game time before a run counts as a timeout")
+    parser.add_argument("--json", metavar="PATH", help="also write the summaries here")
+    args = parser.parse_args()
+
+    configs = build_configs(args.set, args.sweep)
+    for overrides in configs:
+        try:
+            apply_config(overrides)
+        except (KeyError, TypeError) as e:
+            parser.error(f"bad setting in {config_name(overrides)}: {e}")
+    apply_config({})
+
+    seeds = list(range(args.seed, args.seed + args.runs))
+    max_ticks = int(args.max_seconds * main.TICK_RATE)
+    start = time.perf_counter()
+    results = {}
+    with ProcessPoolExecutor(args.workers) as pool:
+        jobs = [(config_name(o), pool.submit(play_chunk, o, seeds[k:k+CHUNK], args.bot, max_ticks))
+                for o in configs for k in range(0, len(seeds), CHUNK)]
+        for name, job in jobs:
+            results.setdefault(name, []).extend(job.result())
+
+    summaries = {name: summarize(runs) for name, runs in results.items()}
+    for name, s in summaries.items():
+        print_summary(name, s)
+    print(f"{len(configs)*len(seeds)} runs in {time.perf_counter()-start:.1f}s")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summaries, f, indent=2)
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
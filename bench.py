@@ -0,0 +1,211 @@
+# Headless benchmark harness for the game logic and renderer.
+#
+#   python bench.py                 run every scenario, compare to baseline
+#   python bench.py horde_500       run only the named scenarios
+#   python bench.py --save          run and store the results as the baseline
+#
+# Runs under SDL's dummy video driver, so no window is opened. Each
+# scenario reports frames/sec, ms/frame percentiles, peak traced memory and
+# the game's Rect() constructor calls per frame (counted by the profiler;
+# Rects that pygame itself returns, from blit and the like, are not). A
+# scenario whose p50 is more than --tolerance slower than the stored
+# baseline, or that makes more Rect() calls per frame, counts as a
+# regression and makes the script exit with status 1. Timing baselines are
+# machine specific: re-save them when changing hardware.
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import pygame
+import main
+
+BASELINE_PATH = "bench_baseline.json"
+
+def invulnerable(sim):
+    sim.player.max_health = sim.player.health = 10**9
+
+def random_inputs(rng):
+    return main.Inputs(dx=rng.choice((-1, 0, 1)), dy=rng.choice((-1, 0, 1)),
+                       attack=(rng.randint(0, main.SCREEN_WIDTH), rng.randint(0, main.SCREEN_HEIGHT))
+                              if rng.random() < 0.05 else None,
+                       open_chests=rng.random() < 0.05)
+
+# Every scenario is a setup function returning a per-frame callable.
+
+def default_room():
+    sim = main.Simulation(seed=1)
+    renderer = main.DirtyRenderer()
+    rng = random.Random(1)
+    def frame():
+        if sim.state != "play":
+            sim.reset(sim.seed)
+            renderer.invalidate()
+        sim.step(random_inputs(rng))
+        renderer.draw(main.screen, sim)
+    return frame
+
+def full_redraw():
+    sim = main.Simulation(seed=1)
+    def frame():
+        i = sim.current_room
+        main.draw_room(main.screen, i, sim.rooms[i], sim.room_themes[i])
+        main.draw_sprites(main.screen, sim)
+        pygame.display.flip()
+    return frame
+
+def horde_500():
+    sim = main.Simulation(seed=2)
+    invulnerable(sim)
+    grid = sim.rooms[0]
+    _, enemies, _ = sim.room_data[0]
+    rng = random.Random(2)
+    while len(enemies) < 500:
+        e = main.Enemy(rng.uniform(main.TILE, main.SCREEN_WIDTH - 2*main.TILE),
+                       rng.uniform(main.TILE, main.SCREEN_HEIGHT - 2*main.TILE),
+                       rng.choice(main.ENEMY_KINDS))
+        if not main.wall_collision(e, grid):
+            e.hp = 10**9
+            enemies.append(e)
+    # the player dodges around the middle of the room
+    def frame():
+        f = sim.frame
+        sim.step(main.Inputs(dx=(f//40) % 3 - 1, dy=(f//55) % 3 - 1))
+    return frame
+
+def fireballs_1000():
+    sim = main.Simulation(seed=3)
+    invulnerable(sim)
+    sim.projectiles = main.FireballPool(2048)
+    sim.room_data[0][1].clear()
+    rng = random.Random(3)
+    def frame():
+        pool = sim.projectiles
+        while len(pool) < 1000:
+            a = rng.uniform(0, 6.283)
+            pool.spawn(rng.uniform(40, main.SCREEN_WIDTH-40), rng.uniform(40, main.SCREEN_HEIGHT-40),
+                       main.FIREBALL_SPEED*main.math.cos(a), main.FIREBALL_SPEED*main.math.sin(a))
+        sim.step(main.Inputs())
+    return frame
+
+def regenerate():
+    seeds = iter(range(10**9))
+    def frame():
+        main.generate_static_dungeon(main.Dungeon(next(seeds)))
+    return frame
+
+def soak_10k():
+    sim = main.Simulation(seed=4)
+    rng = random.Random(4)
+    def frame():
+        if sim.state != "play":
+            sim.reset()
+        sim.step(random_inputs(rng))
+    return frame
+
+SCENARIOS = {
+    "default_room": (default_room, 600),
+    "full_redraw": (full_redraw, 300),
+    "horde_500": (horde_500, 300),
+    "fireballs_1000": (fireballs_1000, 600),
+    "regenerate": (regenerate, 50),
+    "soak_10k": (soak_10k, 10000),
+}
+
+def percentile(ordered, q):
+    return ordered[min(int(q*len(ordered)), len(ordered)-1)]
+
+def run(name):
+    setup, frames = SCENARIOS[name]
+
+    frame = setup()
+    times = []
+    start = time.perf_counter()
+    for _ in range(frames):
+        t = time.perf_counter()
+        frame()
+        times.append((time.perf_counter() - t)*1000)
+    total = time.perf_counter() - start
+
+    # memory on a separate, shorter pass: tracemalloc slows everything down
+    tracemalloc.start()
+    frame = setup()
+    for _ in range(min(frames, 200)):
+        frame()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # and Rect() calls on a third, with the profiler's counting on
+    frame = setup()
+    main.profiler.enable()
+    for _ in range(min(frames, 200)):
+        frame()
+    rect_calls = main.perf_counts["rect_calls"]/min(frames, 200)
+    main.profiler.disable()
+
+    times.sort()
+    return {
+        "frames": frames,
+        "fps": frames/total,
+        "p50_ms": percentile(times, 0.5),
+        "p95_ms": percentile(times, 0.95),
+        "p99_ms": percentile(times, 0.99),
+        "peak_kib": peak//1024,
+        "rect_calls_per_frame": rect_calls,
+    }
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenarios", nargs="*", help="any of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--save", action="store_true", help="store results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed p50 slowdown against the baseline (default 0.25)")
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error("unknown scenario: " + ", ".join(unknown))
+
+    main.init_display()
+    main.load_assets()
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print(f"{'scenario':<16}{'fps':>10}{'p50':>9}{'p95':>9}{'p99':>9}{'peak KiB':>10}{'Rect()/f':>9}  vs baseline")
+    for name in args.scenarios or SCENARIOS:
+        r = results[name] = run(name)
+        note = ""
+        if name in baseline:
+            ratio = r["p50_ms"]/baseline[name]["p50_ms"]
+            note = f"{ratio:5.2f}x"
+            if ratio > 1 + args.tolerance:
+                note += "  REGRESSION"
+                regressions.append(name)
+            # the scenarios are seeded, so their Rect() counts are exact
+            if r["rect_calls_per_frame"] > baseline[name].get("rect_calls_per_frame", r["rect_calls_per_frame"]):
+                note += "  MORE RECT CALLS"
+                regressions.append(name)
+        print(f"{name:<16}{r['fps']:10.0f}{r['p50_ms']:9.3f}{r['p95_ms']:9.3f}{r['p99_ms']:9.3f}"
+              f"{r['peak_kib']:10}{r['rect_calls_per_frame']:9.1f}  {note}")
+
+    if args.save:
+        baseline.update(results)
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"baseline written to {BASELINE_PATH}")
+    elif regressions:
+        print("regressed: " + ", ".join(regressions))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
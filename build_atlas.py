@@ -0,0 +1,51 @@
+# Packs every PNG under images/ into one texture atlas so the game loads a
+# single sheet (one fetch in the pygbag build) instead of ~20 files.
+#
+#   python build_atlas.py
+#
+# Writes images/atlas.png and images/atlas.json. Rerun it after adding or
+# editing any image: main.py falls back to the loose files when the atlas
+# is missing or older than them, but the web build ships only the atlas.
+import glob
+import json
+import os
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame
+
+ATLAS_WIDTH = 256
+PADDING = 1
+
+def build(src_dir="images"):
+    paths = sorted(p for p in glob.glob(os.path.join(src_dir, "*.png"))
+                   if os.path.basename(p) != "atlas.png")
+    images = [(p.replace(os.sep, "/"), pygame.image.load(p)) for p in paths]
+
+    # shelf packing, tallest first
+    images.sort(key=lambda item: (-item[1].get_height(), item[0]))
+    x = y = shelf = 0
+    placed = {}
+    for path, img in images:
+        w, h = img.get_size()
+        if x + w > ATLAS_WIDTH:
+            x = 0
+            y += shelf + PADDING
+            shelf = 0
+        placed[path] = (x, y, w, h)
+        x += w + PADDING
+        shelf = max(shelf, h)
+
+    sheet = pygame.Surface((ATLAS_WIDTH, y + shelf), pygame.SRCALPHA)
+    sheet.fill((0, 0, 0, 0))
+    for path, img in images:
+        sheet.blit(img, placed[path][:2])
+
+    pygame.image.save(sheet, os.path.join(src_dir, "atlas.png"))
+    with open(os.path.join(src_dir, "atlas.json"), "w") as f:
+        json.dump({"version": 1, "sprites": placed}, f, sort_keys=True)
+    return sheet.get_size(), len(placed)
+
+if __name__ == "__main__":
+    pygame.init()
+    size, count = build()
+    print(f"packed {count} images into a {size[0]}x{size[1]} atlas")
@@ -0,0 +1,97 @@
+# Compiles content/content.json (enemy kinds, items, room themes) into
+# content/content.bin, the binary form main.py loads at startup.
+#
+#   python build_content.py
+#
+# Rerun it after editing the JSON; until then main.py notices the compiled
+# file is older and reads the JSON directly. The layout is described next
+# to read_content in main.py. Mistakes in the JSON (unknown behaviours,
+# pools naming missing kinds, images that don't exist) are reported here
+# rather than at game startup.
+import json
+import os
+import struct
+import sys
+import zlib
+
+SRC = "content/content.json"
+OUT = "content/content.bin"
+MAGIC = b"DGCT"
+VERSION = 1
+BEHAVIOURS = ("walker", "phaser", "shooter")
+
+def check(data):
+    errors = []
+    names = [e["name"] for e in data["enemies"]]
+    if len(set(names)) != len(names):
+        errors.append("enemy names must be unique")
+    for e in data["enemies"]:
+        if e["behaviour"] not in BEHAVIOURS:
+            errors.append(f"enemy {e['name']}: behaviour must be one of {', '.join(BEHAVIOURS)}")
+        if e["hp"] <= 0 or e["speed"] < 0:
+            errors.append(f"enemy {e['name']}: hp must be positive and speed not negative")
+    for pool in ("shallow_enemies", "deep_enemies"):
+        if not data[pool]:
+            errors.append(f"{pool} is empty")
+        for name in data[pool]:
+            if name not in names:
+                errors.append(f"{pool} names unknown enemy {name}")
+    for name, cfg in data["rooms"].items():
+        if not 0 < cfg["enemy_min"] <= cfg["enemy_max"] < 256:
+            errors.append(f"room {name}: need 0 < enemy_min <= enemy_max < 256")
+    for theme in ("normal", "library", "final"):
+        if theme not in data["rooms"]:
+            errors.append(f"room theme {theme} is required")
+    for entry in data["enemies"] + data["items"]:
+        if not os.path.exists(entry["image"]):
+            errors.append(f"{entry['name']}: missing image {entry['image']}")
+    return errors
+
+def compile_content(data):
+    strings = []
+    index = {}
+    def s(text):
+        if text not in index:
+            index[text] = len(strings)
+            strings.append(text)
+        return index[text]
+
+    enemies = data["enemies"]
+    ids = {e["name"]: i for i, e in enumerate(enemies)}
+    body = bytearray([len(enemies)])
+    for e in enemies:
+        body += struct.pack("<HHBhdh", s(e["name"]), s(e["image"]), BEHAVIOURS.index(e["behaviour"]),
+                            e["hp"], e["speed"], e["contact_damage"])
+    body.append(len(data["items"]))
+    for it in data["items"]:
+        body += struct.pack("<HHh", s(it["name"]), s(it["image"]), it["heal"])
+    body.append(len(data["rooms"]))
+    for name, cfg in data["rooms"].items():
+        body += struct.pack("<HBBB", s(name), cfg["enemy_min"], cfg["enemy_max"], cfg["no_chests"])
+    for pool in ("shallow_enemies", "deep_enemies"):
+        body.append(len(data[pool]))
+        body += bytes(ids[name] for name in data[pool])
+    body += struct.pack("<dB", data["library_chance"], data["deep_room_depth"])
+
+    out = bytearray(MAGIC + bytes([VERSION]))
+    out += struct.pack("<H", len(strings))
+    for text in strings:
+        raw = text.encode()
+        out += bytes([len(raw)]) + raw
+    out += body
+    out += struct.pack("<I", zlib.crc32(out))
+    return bytes(out)
+
+if __name__ == "__main__":
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    with open(SRC) as f:
+        data = json.load(f)
+    errors = check(data)
+    if errors:
+        print("\n".join(errors))
+        sys.exit(1)
+    blob = compile_content(data)
+    with open(OUT, "wb") as f:
+        f.write(blob)
+    print(f"compiled {len(data['enemies'])} enemies, {len(data['items'])} items and "
+          f"{len(data['rooms'])} room themes into {OUT} ({len(blob)} bytes)")
@@ -1,7 +1,22 @@
 import pygame
+import asyncio
+import json
 import math
+import os
 import random
-
+import struct
+import sys
+import time
+import zlib
+from collections import OrderedDict, deque
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# startup milestones (Profiler.mark) are timed from here
+STARTED = time.perf_counter()
 pygame.init()
 
 # ---------------------------------------
@@ -13,6 +28,13 @@ SCREEN_WIDTH = 800
 SCREEN_HEIGHT = 576   # 18 tiles * 32 px = 576
 FPS = 60
 
+# The simulation always advances in fixed ticks of TICK_MS; speeds and
+# cooldowns are per tick. Rendering runs at whatever rate it can and
+# interpolates between the last two ticks.
+TICK_RATE = 60
+TICK_MS = 1000 / TICK_RATE
+MAX_TICKS_PER_FRAME = 5
+
 PLAYER_SPEED = 2.0
 PLAYER_MAX_HEARTS = 5
 PLAYER_IFRAME_MS = 800
@@ -22,101 +44,549 @@ SWORD_DAMAGE = 2
 SWORD_ARC_DEG = 90
 SWORD_SWING_MS = 160
 
-ENEMY_STATS = {
-    "spider":   {"hp": 3, "speed": 1.4, "contact_damage": 2},
-    "skeleton": {"hp": 5, "speed": 1.1, "contact_damage": 2},
-    "ghost":    {"hp": 4, "speed": 0.9, "contact_damage": 1},
-    "eye":      {"hp": 4, "speed": 0.8, "contact_damage": 0},
-}
-
 FIREBALL_SPEED = 3.0
 FIREBALL_DAMAGE = 1
 FIREBALL_RANGE = 260
 FIREBALL_COOLDOWN_MS = 1200
 
 ROOM_COUNT = 10
-FINAL_ROOM_INDEX = ROOM_COUNT - 1
 
 ROOM_W = SCREEN_WIDTH // TILE
 ROOM_H = SCREEN_HEIGHT // TILE
 
 # ---------------------------------------
-# PYGAME SETUP
+# CONTENT
 # ---------------------------------------
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-pygame.display.set_caption("Dungeon Explorer")
-clock = pygame.time.Clock()
-
-pygame.font.init()
-title_font = pygame.font.SysFont(None, 72)
-info_font = pygame.font.SysFont(None, 32)
-hud_font = pygame.font.SysFont(None, 24)
+# Enemy kinds, items and room themes are data, in content/content.json.
+# build_content.py compiles that into content/content.bin, which is what
+# normally gets loaded; the JSON is read instead when the compiled file is
+# missing or older than it. Every enemy kind gets an integer id (its place
+# in ENEMY_KINDS) and a behaviour number, so per-frame code compares small
+# ints and never kind names. Compiled layout (little endian):
+#   header   "DGCT", version u8
+#   strings  count u16, (length u8, utf-8 bytes) * count
+#   enemies  count u8, (name s, image s, behaviour u8, hp i16, speed f64,
+#            contact damage i16) * count
+#   items    count u8, (name s, image s, heal i16) * count
+#   rooms    count u8, (name s, enemy min u8, enemy max u8, no chests u8) * count
+#   pools    shallow count u8, enemy id u8 * count, deep count u8, enemy id u8 * count
+#   tuning   library chance f64, deep room depth u8
+#   crc u32 of everything before it
+# where "s" is a u16 index into the string table.
+CONTENT_JSON = "content/content.json"
+CONTENT_BIN = "content/content.bin"
+CONTENT_MAGIC = b"DGCT"
+CONTENT_VERSION = 1
+CONTENT_ENEMY = struct.Struct("<HHBhdh")
+CONTENT_ITEM = struct.Struct("<HHh")
+CONTENT_ROOM = struct.Struct("<HBBB")
+CONTENT_TUNING = struct.Struct("<dB")
+
+BEHAVIOURS = ("walker", "phaser", "shooter")
+WALKER, PHASER, SHOOTER = range(len(BEHAVIOURS))
+
+# Parses content.bin back into the same shape as content.json.
+def read_content(raw):
+    if raw[:4]!=CONTENT_MAGIC or raw[4]!=CONTENT_VERSION:
+        raise ValueError(f"not a version {CONTENT_VERSION} content file")
+    if zlib.crc32(raw[:-4])!=struct.unpack_from("<I",raw,len(raw)-4)[0]:
+        raise ValueError("content file is truncated or corrupt")
+    k=5
+    n,=struct.unpack_from("<H",raw,k); k+=2
+    strings=[]
+    for _ in range(n):
+        size=raw[k]
+        strings.append(raw[k+1:k+1+size].decode())
+        k+=1+size
+    data={"enemies":[],"items":[],"rooms":{}}
+    n=raw[k]; k+=1
+    for _ in range(n):
+        name,image,behaviour,hp,speed,contact=CONTENT_ENEMY.unpack_from(raw,k); k+=CONTENT_ENEMY.size
+        data["enemies"].append({"name":strings[name],"hp":hp,"speed":speed,"contact_damage":contact,
+                                "behaviour":BEHAVIOURS[behaviour],"image":strings[image]})
+    n=raw[k]; k+=1
+    for _ in range(n):
+        name,image,heal=CONTENT_ITEM.unpack_from(raw,k); k+=CONTENT_ITEM.size
+        data["items"].append({"name":strings[name],"heal":heal,"image":strings[image]})
+    n=raw[k]; k+=1
+    for _ in range(n):
+        name,lo,hi,no_chests=CONTENT_ROOM.unpack_from(raw,k); k+=CONTENT_ROOM.size
+        data["rooms"][strings[name]]={"enemy_min":lo,"enemy_max":hi,"no_chests":bool(no_chests)}
+    for pool in ("shallow_enemies","deep_enemies"):
+        n=raw[k]
+        data[pool]=[data["enemies"][i]["name"] for i in raw[k+1:k+1+n]]
+        k+=1+n
+    data["library_chance"],data["deep_room_depth"]=CONTENT_TUNING.unpack_from(raw,k)
+    return data
+
+def load_content():
+    if os.path.exists(CONTENT_BIN) and (not os.path.exists(CONTENT_JSON) or
+                                        os.path.getmtime(CONTENT_BIN)>=os.path.getmtime(CONTENT_JSON)):
+        with open(CONTENT_BIN,"rb") as f:
+            return read_content(f.read())
+    with open(CONTENT_JSON) as f:
+        return json.load(f)
+
+def apply_content(data):
+    global ENEMY_STATS, ENEMY_KINDS, ENEMY_IDS, ENEMY_BEHAVIOUR, ENEMY_IMAGE_FILES
+    global ITEM_ORDER, item_heal, ITEM_IMAGE_FILES
+    global ROOM_CONFIG, LIBRARY_CHANCE, DEEP_ROOM_DEPTH, SHALLOW_ENEMIES, DEEP_ENEMIES
+    enemies=data["enemies"]
+    ENEMY_KINDS=[e["name"] for e in enemies]
+    ENEMY_IDS={name:i for i,name in enumerate(ENEMY_KINDS)}
+    ENEMY_STATS={e["name"]:{"hp":e["hp"],"speed":e["speed"],"contact_damage":e["contact_damage"]}
+                 for e in enemies}
+    ENEMY_BEHAVIOUR=[BEHAVIOURS.index(e["behaviour"]) for e in enemies]
+    ENEMY_IMAGE_FILES={e["name"]:e["image"] for e in enemies}
+
+    ITEM_ORDER=[it["name"] for it in data["items"]]
+    item_heal={it["name"]:it["heal"] for it in data["items"]}
+    ITEM_IMAGE_FILES={it["name"]:it["image"] for it in data["items"]}
+
+    ROOM_CONFIG={name:dict(cfg) for name,cfg in data["rooms"].items()}
+    LIBRARY_CHANCE=data["library_chance"]
+    DEEP_ROOM_DEPTH=data["deep_room_depth"]
+    SHALLOW_ENEMIES=list(data["shallow_enemies"])
+    DEEP_ENEMIES=list(data["deep_enemies"])
+
+apply_content(load_content())
 
-game_state = "title"
+# ---------------------------------------
+# PYGAME SETUP
+# ---------------------------------------
+# The display, clock and fonts only exist once init_display() runs, so
+# importing this module (or running a headless Simulation) never opens a window.
+screen = None
+clock = None
+title_font = None
+info_font = None
+hud_font = None
+
+def init_display():
+    global screen, clock, title_font, info_font, hud_font
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    pygame.display.set_caption("Dungeon Explorer")
+    clock = pygame.time.Clock()
+
+    pygame.font.init()
+    title_font = pygame.font.SysFont(None, 72)
+    info_font = pygame.font.SysFont(None, 32)
+    hud_font = pygame.font.SysFont(None, 24)
 
 # ---------------------------------------
 # IMAGE LOADING
 # ---------------------------------------
+# build_atlas.py packs images/ into one sheet plus a JSON index of sprite
+# rects. When it is present every image is a subsurface of that sheet, so
+# startup is one decode and one convert_alpha (one fetch on the web). A PNG
+# edited since the atlas was built is loaded on its own instead, like
+# content.json over a stale content.bin; the web bundle ships only the atlas.
+ATLAS_IMAGE = "images/atlas.png"
+ATLAS_INDEX = "images/atlas.json"
+atlas = None
+atlas_rects = {}
+atlas_mtime = 0.0
+
+def load_atlas():
+    global atlas, atlas_rects, atlas_mtime
+    if not os.path.exists(ATLAS_INDEX):
+        return
+    with open(ATLAS_INDEX) as f:
+        atlas_rects = {path: Rect(r) for path, r in json.load(f)["sprites"].items()}
+    atlas = load_surface(ATLAS_IMAGE)
+    atlas_mtime = min(os.path.getmtime(ATLAS_IMAGE), os.path.getmtime(ATLAS_INDEX))
+
+def load_surface(path):
+    img = pygame.image.load(path)
+    # convert_alpha needs a display mode; headless runs keep the raw surface
+    if pygame.display.get_surface() is not None:
+        img = img.convert_alpha()
+    return img
+
 def load_masked(path):
-    img = pygame.image.load(path).convert_alpha()
-    return img, pygame.mask.from_surface(img)
+    img = load_image(path)
+    mask = pygame.mask.from_surface(img)
+    mask_shapes[mask] = trim_mask(mask)
+    return img, mask
 
 def load_image(path):
-    return pygame.image.load(path).convert_alpha()
-
-player_img, player_mask = load_masked("images/player.png")
-floor_img, _ = load_masked("images/floor.png")
-wall_img, wall_mask = load_masked("images/wall.png")
-library_wall_img, _ = load_masked("images/library.png")
-
-spider_img, spider_mask = load_masked("images/spider.png")
-skeleton_img, skeleton_mask = load_masked("images/skeleton.png")
-ghost_img, ghost_mask = load_masked("images/ghost.png")
-eye_img, eye_mask = load_masked("images/eye.png")
-
-chest_img, chest_mask = load_masked("images/chest.png")
-chest_open_img = load_image("images/chest_open.png")
-
-heart_full = load_image("images/heart_full.png")
-heart_half = load_image("images/heart_half.png")
-heart_empty = load_image("images/heart_empty.png")
-
-apple_img = load_image("images/apple.png")
-bread_img = load_image("images/bread.png")
-meat_img = load_image("images/meat.png")
-chicken_img = load_image("images/chicken.png")
-
-sword_img = load_image("images/sword.png")
-fireball_img = load_image("images/fireball.png")
-
-enemy_images = {
-    "spider": spider_img,
-    "skeleton": skeleton_img,
-    "ghost": ghost_img,
-    "eye": eye_img,
-}
-enemy_masks = {
-    "spider": spider_mask,
-    "skeleton": skeleton_mask,
-    "ghost": ghost_mask,
-    "eye": eye_mask,
-}
-
-ITEM_ORDER = ["apple", "bread", "meat", "chicken"]
-item_images = {
-    "apple": apple_img,
-    "bread": bread_img,
-    "meat": meat_img,
-    "chicken": chicken_img,
-}
-item_heal = {"apple": 1, "bread": 2, "meat": 3, "chicken": 4}
+    if atlas is not None and path in atlas_rects and (not os.path.exists(path) or
+                                                      os.path.getmtime(path)<=atlas_mtime):
+        return atlas.subsurface(atlas_rects[path])
+    return load_surface(path)
+
+assets_loaded = False
+
+def load_assets():
+    for _ in load_asset_steps():
+        pass
+
+# The same loading an image at a time, for callers that spread it over
+# several frames (the title screen, see prepare_run).
+def load_asset_steps():
+    global assets_loaded, player_img, player_mask, floor_img, wall_img, wall_mask, library_wall_img
+    global chest_img, chest_mask, chest_open_img
+    global heart_full, heart_half, heart_empty
+    global sword_img, fireball_img, enemy_images, enemy_masks, item_images
+    if assets_loaded:
+        return
+
+    load_atlas()
+    yield
+    player_img, player_mask = load_masked("images/player.png")
+    yield
+    floor_img, _ = load_masked("images/floor.png")
+    yield
+    wall_img, wall_mask = load_masked("images/wall.png")
+    yield
+    library_wall_img, _ = load_masked("images/library.png")
+    yield
+
+    chest_img, chest_mask = load_masked("images/chest.png")
+    yield
+    chest_open_img = load_image("images/chest_open.png")
+    yield
+
+    heart_full = load_image("images/heart_full.png")
+    yield
+    heart_half = load_image("images/heart_half.png")
+    yield
+    heart_empty = load_image("images/heart_empty.png")
+    yield
+
+    sword_img = load_image("images/sword.png")
+    yield
+    fireball_img = load_image("images/fireball.png")
+    yield
+
+    enemy_images = {}
+    enemy_masks = {}
+    for kind, path in ENEMY_IMAGE_FILES.items():
+        enemy_images[kind], enemy_masks[kind] = load_masked(path)
+        yield
+    item_images = {}
+    for name, path in ITEM_IMAGE_FILES.items():
+        item_images[name] = load_image(path)
+        yield
+    assets_loaded = True
+
+# Rotated copies of sprites, quantized to ROTATION_STEPS angles and built
+# on first use. Entries also carry the offset that puts the sprite's centre
+# at `radius` pixels out along the angle. Least recently used entries are
+# dropped past max_size.
+ROTATION_STEPS = 64
+ROTATION_CACHE_SIZE = 256
+
+class RotationCache:
+    def __init__(self, steps=ROTATION_STEPS, max_size=ROTATION_CACHE_SIZE):
+        self.steps = steps
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, img, angle, radius=0):
+        step = round(angle*self.steps/360) % self.steps
+        key = (img, step, radius)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry
+        a = step*360/self.steps
+        rot = pygame.transform.rotate(img, -a)
+        rad = math.radians(a)
+        entry = (rot,
+                 math.cos(rad)*radius - rot.get_width()/2,
+                 math.sin(rad)*radius - rot.get_height()/2)
+        self.entries[key] = entry
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return entry
+
+rotations = RotationCache()
+
+
+# ---------------------------------------
+# PROFILING
+# ---------------------------------------
+# Per-phase frame timings, toggled with F3 in game (F4 dumps them). Each
+# phase is timed by lap(), which charges the time since the previous lap
+# to that phase. end_frame() files the frame's totals into a rolling
+# window, from which the overlay shows p50/p99. While enabled, pixel_collision
+# calls and this module's Rect() constructor calls are counted.
+# Frame pacing (the time between frames, as clock.tick reports it) and the
+# startup milestones are recorded whether or not the profiler is enabled,
+# and go into the profile.json that F4 writes.
+PROFILE_PHASES = ("events", "move", "transition", "enemies", "melee", "projectiles",
+                  "world", "draw_room", "entities", "hud", "flip")
+PROFILE_WINDOW = 240
+PACING_WINDOW = 60*FPS
+HITCH_MS = 1.5*1000/FPS   # a frame interval longer than this is a visible hitch
+
+perf_counts = {"pixel_collision": 0, "mask_overlap": 0, "rect_calls": 0}
+perf_counting = False   # pixel_collision only counts while the profiler is on
+
+# Everything here builds its Rects through Rect, which the profiler points
+# at counting_rect while it is on. That counts constructor calls only:
+# Rects pygame hands back (blit, copy, clip, ...) are not seen.
+Rect = pygame.Rect
+
+def counting_rect(*args):
+    perf_counts["rect_calls"] += 1
+    return pygame.Rect(*args)
+
+class Profiler:
+    def __init__(self, window=PROFILE_WINDOW):
+        self.enabled = False
+        self.samples = {p: deque(maxlen=window) for p in PROFILE_PHASES}
+        self.counts = {c: deque(maxlen=window) for c in perf_counts}
+        self.current = dict.fromkeys(PROFILE_PHASES, 0.0)
+        self.intervals = deque(maxlen=PACING_WINDOW)
+        self.startup = {}
+        self.last = 0.0
+        self.overlay = None
+        self.overlay_age = 0
+
+    def enable(self):
+        global perf_counting, Rect
+        self.enabled = True
+        perf_counting = True
+        for c in perf_counts:
+            perf_counts[c] = 0
+        Rect = counting_rect
+        self.start()
+
+    def disable(self):
+        global perf_counting, Rect
+        self.enabled = False
+        perf_counting = False
+        Rect = pygame.Rect
+
+    def toggle(self):
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def start(self):
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.current[phase] += (now - self.last)*1000
+        self.last = now
+
+    # ms since STARTED, kept for the first time a milestone is reached
+    def mark(self, name):
+        self.startup.setdefault(name, (time.perf_counter() - STARTED)*1000)
+
+    def end_frame(self, interval):
+        self.intervals.append(interval)
+        if not self.enabled:
+            return
+        for p in PROFILE_PHASES:
+            self.samples[p].append(self.current[p])
+            self.current[p] = 0.0
+        for c in perf_counts:
+            self.counts[c].append(perf_counts[c])
+            perf_counts[c] = 0
+
+    def percentile(self, values, q):
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return ordered[min(int(q*len(ordered)), len(ordered)-1)]
+
+    def summary(self):
+        out = {p: {"p50": self.percentile(v, 0.5), "p99": self.percentile(v, 0.99),
+                   "mean": sum(v)/len(v) if v else 0.0}
+               for p, v in self.samples.items()}
+        for c, v in self.counts.items():
+            out[c + "_per_frame"] = sum(v)/len(v) if v else 0.0
+        out["frame_interval"] = self.pacing()
+        out["startup_ms"] = dict(self.startup)
+        return out
+
+    def pacing(self):
+        v = self.intervals
+        return {"p50": self.percentile(v, 0.5), "p99": self.percentile(v, 0.99),
+                "max": max(v, default=0), "hitches": sum(i > HITCH_MS for i in v)}
+
+    # .json gets the summary, anything else a CSV row per frame in the window
+    def dump(self, path):
+        if path.endswith(".json"):
+            with open(path, "w") as f:
+                json.dump(self.summary(), f, indent=2)
+            return
+        with open(path, "w") as f:
+            f.write(",".join(PROFILE_PHASES + tuple(self.counts)) + "\n")
+            columns = [self.samples[p] for p in PROFILE_PHASES] + list(self.counts.values())
+            for row in zip(*columns):
+                f.write(",".join(f"{v:.4f}" if isinstance(v, float) else str(v) for v in row) + "\n")
+
+    def draw(self, s):
+        if self.overlay is None or self.overlay_age >= 30:
+            summary = self.summary()
+            lines = [f"{p:<12}{summary[p]['p50']:6.2f}{summary[p]['p99']:7.2f}" for p in PROFILE_PHASES]
+            lines.insert(0, f"{'phase':<12}{'p50':>6}{'p99':>7}  ms")
+            pacing = summary["frame_interval"]
+            lines.append(f"{'interval':<12}{pacing['p50']:6.2f}{pacing['p99']:7.2f}")
+            lines.append(f"pixel_collision/frame {summary['pixel_collision_per_frame']:.0f}")
+            lines.append(f"Rect() calls/frame {summary['rect_calls_per_frame']:.0f}")
+            rendered = [hud_font.render(line, True, (255, 255, 0)) for line in lines]
+            w = max(r.get_width() for r in rendered) + 8
+            h = sum(r.get_height() for r in rendered) + 8
+            self.overlay = pygame.Surface((w, h), pygame.SRCALPHA)
+            self.overlay.fill((0, 0, 0, 170))
+            y = 4
+            for r in rendered:
+                self.overlay.blit(r, (4, y))
+                y += r.get_height()
+            self.overlay_age = 0
+        self.overlay_age += 1
+        return s.blit(self.overlay, (10, SCREEN_HEIGHT - self.overlay.get_height() - 10))
+
+profiler = Profiler()
 
 # ---------------------------------------
 # COLLISION HELPERS
 # ---------------------------------------
+# Every mask's size, the box around its set bits and a copy of the mask
+# cropped to that box: (w, h, bx, by, bw, bh, cropped). Filled in when
+# sprites load, so collision tests never look at empty margins.
+mask_shapes = {}
+
+def trim_mask(mask):
+    w, h = mask.get_size()
+    rects = mask.get_bounding_rects()
+    box = rects[0].unionall(rects[1:]) if rects else Rect(0, 0, 0, 0)
+    cropped = pygame.Mask(box.size)
+    cropped.draw(mask, (-box.x, -box.y))
+    return (w, h, box.x, box.y, box.w, box.h, cropped)
+
+# Mask test of obj against a mask placed at (tx, ty). Cheapest test first:
+# the two sprite boxes, then the boxes around their set bits, and only if
+# both overlap the (cropped) masks themselves.
 def pixel_collision(obj, tx, ty, tmask):
-    offset = (int(tx - obj.x), int(ty - obj.y))
-    return obj.mask.overlap(tmask, offset) is not None
+    if perf_counting:
+        perf_counts["pixel_collision"] += 1
+    ox = int(tx - obj.x)
+    oy = int(ty - obj.y)
+    a = mask_shapes.get(obj.mask) or mask_shapes.setdefault(obj.mask, trim_mask(obj.mask))
+    b = mask_shapes.get(tmask) or mask_shapes.setdefault(tmask, trim_mask(tmask))
+    if ox >= a[0] or oy >= a[1] or ox+b[0] <= 0 or oy+b[1] <= 0:
+        return False
+    lx = ox+b[2]
+    ly = oy+b[3]
+    if lx >= a[2]+a[4] or ly >= a[3]+a[5] or lx+b[4] <= a[2] or ly+b[5] <= a[3]:
+        return False
+    if perf_counting:
+        perf_counts["mask_overlap"] += 1
+    return a[6].overlap(b[6], (lx-a[2], ly-a[3])) is not None
+
+# Walls live on the room grid, so only the few tiles under the entity's
+# bounding box can overlap it. The box is padded by a pixel because
+# pixel_collision truncates the offset toward zero.
+def wall_collision(obj, grid):
+    x0 = max(math.floor(obj.x-1)//TILE, 0)
+    y0 = max(math.floor(obj.y-1)//TILE, 0)
+    x1 = min(math.floor(obj.x+obj.width+1)//TILE, ROOM_W-1)
+    y1 = min(math.floor(obj.y+obj.height+1)//TILE, ROOM_H-1)
+    for gy in range(y0, y1+1):
+        row = grid[gy]
+        for gx in range(x0, x1+1):
+            if row[gx] == 1 and pixel_collision(obj, gx*TILE, gy*TILE, wall_mask):
+                return True
+    return False
+
+# Moves obj by (dx, dy) unless that runs it into a wall anywhere along the
+# way, in which case it stays put and this returns True. Long moves are
+# checked in steps of at most SWEEP_STEP pixels, less than a wall tile, so
+# a dash can't jump clean over a wall; an ordinary step is a single test.
+SWEEP_STEP = TILE//2
+
+def swept_collision(obj, dx, dy, grid):
+    ox, oy = obj.x, obj.y
+    steps = max(1, math.ceil(max(abs(dx), abs(dy))/SWEEP_STEP))
+    for k in range(1, steps+1):
+        obj.x = ox + dx*k/steps
+        obj.y = oy + dy*k/steps
+        if wall_collision(obj, grid):
+            obj.x, obj.y = ox, oy
+            return True
+    return False
+
+# Whether the segment from (x0, y0) to (x1, y1) passes through a wall tile,
+# walking the tiles it crosses in order (grid DDA). Points are truncated to
+# whole pixels the way the point tests do, and the crossings are compared
+# in integers, so a segment through a tile corner is exact: the corner
+# point itself lies in the tile below and/or to the right of it, like any
+# point on a tile edge. The end tile is always tested.
+def segment_hits_wall(x0, y0, x1, y1, grid):
+    x0 = int(x0); y0 = int(y0); x1 = int(x1); y1 = int(y1)
+    gx = x0//TILE; gy = y0//TILE
+    ex = x1//TILE; ey = y1//TILE
+    adx = abs(x1-x0); ady = abs(y1-y0)
+    sx = 1 if x1 > x0 else -1
+    sy = 1 if y1 > y0 else -1
+    # pixels along each axis to the next tile edge; the crossing is at
+    # nx/adx (ny/ady) of the way along the segment
+    nx = (gx+1)*TILE - x0 if sx > 0 else x0 - gx*TILE
+    ny = (gy+1)*TILE - y0 if sy > 0 else y0 - gy*TILE
+    while True:
+        if 0 <= gx < ROOM_W and 0 <= gy < ROOM_H and grid[gy][gx] == 1:
+            return True
+        cx = adx and nx < adx
+        cy = ady and ny < ady
+        if not (cx or cy):
+            break
+        d = nx*ady - ny*adx if cx and cy else (-1 if cx else 1)
+        if d < 0 or (d == 0 and sx > sy):
+            gx += sx
+            nx += TILE
+        elif d > 0 or sy > sx:
+            gy += sy
+            ny += TILE
+        else:
+            # through a corner with both steps the same way: diagonally
+            gx += sx
+            nx += TILE
+            gy += sy
+            ny += TILE
+    return 0 <= ex < ROOM_W and 0 <= ey < ROOM_H and grid[ey][ex] == 1
+
+# Uniform grid of TILE-sized buckets. Entities are stored by their index in
+# the list they came from, and queries hand back indices in list order so
+# callers behave exactly like a plain loop over that list.
+class SpatialHash:
+    def __init__(self, items=(), cell=TILE):
+        self.cell = cell
+        self.cells = {}
+        for i, obj in enumerate(items):
+            self.insert(i, obj.rect)
+
+    def insert(self, key, rect):
+        c = self.cell
+        for cy in range(rect.top//c, (rect.bottom-1)//c+1):
+            for cx in range(rect.left//c, (rect.right-1)//c+1):
+                self.cells.setdefault((cx, cy), []).append(key)
+
+    def query_box(self, left, top, right, bottom):
+        c = self.cell
+        found = set()
+        for cy in range(int(top)//c, int(bottom)//c+1):
+            for cx in range(int(left)//c, int(right)//c+1):
+                found.update(self.cells.get((cx, cy), ()))
+        return sorted(found)
+
+    def query_rect(self, rect):
+        return self.query_box(rect.left, rect.top, rect.right-1, rect.bottom-1)
+
+    def query_radius(self, x, y, r):
+        return self.query_box(x-r, y-r, x+r, y+r)
+
+def lerp(a, b, t):
+    return a + (b - a)*t
 
 def angle_between(dx, dy):
     return math.degrees(math.atan2(dy, dx))
@@ -124,62 +594,175 @@ def angle_between(dx, dy):
 def angle_diff(a, b):
     return (a - b + 180) % 360 - 180
 
+# ---------------------------------------
+# PATHFINDING
+# ---------------------------------------
+# BFS flow field over a room grid toward the player's tile. Every open tile
+# stores the centre of the next tile on its shortest path, so enemies only
+# do a lookup per frame. Diagonal steps are allowed when both orthogonal
+# neighbours are open, so paths never cut a pillar's corner. The field is
+# rebuilt only when the room or the player's tile changes.
+FLOW_STEPS = [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)]
+
+class FlowField:
+    def __init__(self):
+        self.grid = None
+        self.target = None
+        self.links = None
+        self.hop_x = [-1]*(ROOM_W*ROOM_H)
+        self.hop_y = [-1]*(ROOM_W*ROOM_H)
+        self.arrays = None
+
+    # Open neighbours of every tile, flattened to y*ROOM_W+x. Built once per
+    # room so the BFS itself is just index lookups.
+    def build_links(self, grid):
+        links = [()]*(ROOM_W*ROOM_H)
+        for y in range(ROOM_H):
+            for x in range(ROOM_W):
+                if grid[y][x] == 1:
+                    continue
+                out = []
+                for sx, sy in FLOW_STEPS:
+                    nx, ny = x+sx, y+sy
+                    if not (0 <= nx < ROOM_W and 0 <= ny < ROOM_H) or grid[ny][nx] == 1:
+                        continue
+                    if sx and sy and (grid[ny][x] == 1 or grid[y][nx] == 1):
+                        continue
+                    out.append(ny*ROOM_W+nx)
+                links[y*ROOM_W+x] = out
+        return links
+
+    def update(self, grid, tx, ty):
+        if grid is self.grid and (tx, ty) == self.target:
+            return self
+        if grid is not self.grid:
+            self.links = self.build_links(grid)
+        self.grid = grid
+        self.target = (tx, ty)
+        self.arrays = None
+        hop_x = self.hop_x = [-1]*(ROOM_W*ROOM_H)
+        hop_y = self.hop_y = [-1]*(ROOM_W*ROOM_H)
+        if not (0 <= tx < ROOM_W and 0 <= ty < ROOM_H) or grid[ty][tx] == 1:
+            return self
+
+        # tiles at distance <= 1 keep hop -1 and chase the player directly
+        links = self.links
+        seen = [False]*(ROOM_W*ROOM_H)
+        start = ty*ROOM_W+tx
+        seen[start] = True
+        frontier = [start]
+        for k in links[start]:
+            seen[k] = True
+            frontier.append(k)
+        queue = frontier[1:]
+        for k in queue:
+            cx = (k % ROOM_W)*TILE + TILE//2
+            cy = (k // ROOM_W)*TILE + TILE//2
+            for n in links[k]:
+                if not seen[n]:
+                    seen[n] = True
+                    hop_x[n] = cx
+                    hop_y[n] = cy
+                    queue.append(n)
+        return self
+
+    # Centre of the next tile to walk to from pixel (x, y), or None when the
+    # enemy should head straight for the player.
+    def next_hop(self, x, y):
+        gx = x//TILE
+        gy = y//TILE
+        if not (0 <= gx < ROOM_W and 0 <= gy < ROOM_H):
+            return None
+        k = gy*ROOM_W+gx
+        if self.hop_x[k] < 0:
+            return None
+        return self.hop_x[k], self.hop_y[k]
+
+    def hop_arrays(self):
+        if self.arrays is None:
+            self.arrays = (np.array(self.hop_x).reshape(ROOM_H, ROOM_W),
+                           np.array(self.hop_y).reshape(ROOM_H, ROOM_W))
+        return self.arrays
+
 # ---------------------------------------
 # DUNGEON GRAPH
 # ---------------------------------------
-NEIGHBORS = {
-    0: {"N": None, "E": 1, "S": 2, "W": None},
-    1: {"N": None, "E": 3, "S": 4, "W": 0},
-    2: {"N": 0,    "E": 4, "S": None, "W": None},
-    3: {"N": None, "E": None, "S": 6, "W": 1},
-    4: {"N": 1,    "E": 7, "S": 5, "W": 2},
-    5: {"N": 4,    "E": 8, "S": None, "W": None},
-    6: {"N": 3,    "E": None, "S": None, "W": None},
-    7: {"N": None, "E": 9, "S": None, "W": 4},
-    8: {"N": 5,    "E": None, "S": None, "W": None},
-    9: {"N": None, "E": None, "S": None, "W": None},
-}
-
-ROOM_CONFIG = {
-    i: {
-        "theme": "final" if i == 9 else ("library" if i in (3,5) else "normal"),
-        "enemy_min": 10 if i == 9 else 8,
-        "enemy_max": 12 if i == 9 else 12,
-        "enemy_types": ["skeleton", "ghost", "eye"] if i >= 3 else ["spider", "skeleton", "ghost"],
-        "no_chests": (i == 9)
-    }
-    for i in range(ROOM_COUNT)
-}
-
-EXTRA_WALLS = {
-    0: [],
-    1: [(5, 4), (14, 4), (5, 9), (14, 9)],
-    2: [(8, 5), (11, 5), (8, 8), (11, 8)],
-    3: [(4, 4), (15, 4), (4, 9), (15, 9)],
-    4: [(6, 6), (13, 6), (6, 7), (13, 7)],
-    5: [(3, 5), (16, 5), (9, 3), (9, 10)],
-    6: [(7, 4), (12, 4), (7, 9), (12, 9)],
-    7: [(4, 6), (15, 6), (9, 4), (9, 9)],
-    8: [(6, 4), (13, 4), (6, 9), (13, 9)],
-    9: [(8, 6), (11, 6), (8, 7), (11, 7)],
-}
-
-rooms = []
-room_themes = []
-room_doors = []
-room_data = []
+DIRS = ("N", "E", "S", "W")
+DIR_STEP = {"N": (0, -1), "E": (1, 0), "S": (0, 1), "W": (-1, 0)}
+OPPOSITE = {"N": "S", "E": "W", "S": "N", "W": "E"}
+
+# Rooms sit on an integer lattice. Each new room is hung off a random free
+# side of an already placed room, so the rooms always form a tree rooted at
+# room 0 and every room (the final one included) is reachable. Each placed
+# room adds at most four candidate sides and each candidate is looked at
+# once, so generation is linear in the room count.
+class Dungeon:
+    def __init__(self, seed, room_count=ROOM_COUNT):
+        rng = random.Random(f"{seed}/graph")
+        self.seed = seed
+        self.pos = [(0, 0)]
+        self.depth = [0]
+        self.neighbors = [{d: None for d in DIRS}]
+        cells = {(0, 0): 0}
+        frontier = [(0, d) for d in DIRS]
+
+        while len(self.pos) < room_count:
+            k = rng.randrange(len(frontier))
+            frontier[k], frontier[-1] = frontier[-1], frontier[k]
+            parent, d = frontier.pop()
+            px, py = self.pos[parent]
+            sx, sy = DIR_STEP[d]
+            cell = (px+sx, py+sy)
+            if cell in cells:
+                continue
+
+            i = len(self.pos)
+            cells[cell] = i
+            self.pos.append(cell)
+            self.depth.append(self.depth[parent]+1)
+            self.neighbors.append({d: None for d in DIRS})
+            self.neighbors[parent][d] = i
+            self.neighbors[i][OPPOSITE[d]] = parent
+            frontier.extend((i, nd) for nd in DIRS if nd != OPPOSITE[d])
+
+        # the deepest room is the one furthest from the start
+        self.final_room = max(range(room_count), key=self.depth.__getitem__)
+
+    @property
+    def room_count(self):
+        return len(self.pos)
+
+def room_config(dungeon, i, rng):
+    if i == dungeon.final_room:
+        theme = "final"
+    elif i != 0 and rng.random() < LIBRARY_CHANCE:
+        theme = "library"
+    else:
+        theme = "normal"
+    cfg = dict(ROOM_CONFIG[theme], theme=theme)
+    cfg["enemy_types"] = DEEP_ENEMIES if dungeon.depth[i] >= DEEP_ROOM_DEPTH else SHALLOW_ENEMIES
+    return cfg
+
+# Four pillars mirrored about the room centre, kept clear of the door
+# lanes and the tiles the player is dropped on when entering a room.
+def extra_walls(i, rng):
+    if i == 0:
+        return []
+    x = rng.randint(4, ROOM_W//2-2)
+    y = rng.randint(3, ROOM_H//2-2)
+    return [(x, y), (ROOM_W-1-x, y), (x, ROOM_H-1-y), (ROOM_W-1-x, ROOM_H-1-y)]
 
 # ---------------------------------------
 # ROOM GENERATION
 # ---------------------------------------
-def make_static_room(room_index):
+def make_static_room(n, walls=()):
     grid = [[1]*ROOM_W for _ in range(ROOM_H)]
 
     for y in range(1, ROOM_H-1):
         for x in range(1, ROOM_W-1):
             grid[y][x] = 0
 
-    for (x,y) in EXTRA_WALLS.get(room_index, []):
+    for (x,y) in walls:
         if 1 <= x < ROOM_W-1 and 1 <= y < ROOM_H-1:
             grid[y][x] = 1
 
@@ -187,27 +770,26 @@ def make_static_room(room_index):
     mid_y = ROOM_H//2
 
     doors = {}
-    n = NEIGHBORS[room_index]
 
     if n["N"] is not None:
         grid[0][mid_x-1] = 0
         grid[0][mid_x] = 0
-        doors["N"] = pygame.Rect((mid_x-1)*TILE, 0, 2*TILE, TILE)
+        doors["N"] = Rect((mid_x-1)*TILE, 0, 2*TILE, TILE)
 
     if n["S"] is not None:
         grid[ROOM_H-1][mid_x-1] = 0
         grid[ROOM_H-1][mid_x] = 0
-        doors["S"] = pygame.Rect((mid_x-1)*TILE, (ROOM_H-1)*TILE, 2*TILE, TILE)
+        doors["S"] = Rect((mid_x-1)*TILE, (ROOM_H-1)*TILE, 2*TILE, TILE)
 
     if n["E"] is not None:
         grid[mid_y-1][ROOM_W-1] = 0
         grid[mid_y][ROOM_W-1] = 0
-        doors["E"] = pygame.Rect((ROOM_W-1)*TILE, (mid_y-1)*TILE, TILE, 2*TILE)
+        doors["E"] = Rect((ROOM_W-1)*TILE, (mid_y-1)*TILE, TILE, 2*TILE)
 
     if n["W"] is not None:
         grid[mid_y-1][0] = 0
         grid[mid_y][0] = 0
-        doors["W"] = pygame.Rect(0, (mid_y-1)*TILE, TILE, 2*TILE)
+        doors["W"] = Rect(0, (mid_y-1)*TILE, TILE, 2*TILE)
 
     return grid, doors
 
@@ -217,63 +799,99 @@ def list_walls(grid):
             for x in range(ROOM_W)
             if grid[y][x] == 1]
 
-def random_free(grid, placed):
-    while True:
-        gx = random.randint(1, ROOM_W-2)
-        gy = random.randint(1, ROOM_H-2)
-        if grid[gy][gx] == 1:
-            continue
-        r = pygame.Rect(gx*TILE, gy*TILE, TILE, TILE)
-        if any(r.colliderect(p) for p in placed):
-            continue
+# Open interior tiles of a room, handed out at random without replacement
+# (a lazy Fisher-Yates shuffle), so each spawn is O(1) and no two entities
+# share a tile.
+class FreeCells:
+    def __init__(self, grid, rng=random):
+        self.rng = rng
+        self.cells = [(x, y)
+                      for y in range(1, ROOM_H-1)
+                      for x in range(1, ROOM_W-1)
+                      if grid[y][x] == 0]
+
+    def __len__(self):
+        return len(self.cells)
+
+    def take(self):
+        cells = self.cells
+        if not cells:
+            raise RuntimeError("no free tile left in room")
+        k = self.rng.randrange(len(cells))
+        cells[k], cells[-1] = cells[-1], cells[k]
+        gx, gy = cells.pop()
         return gx*TILE, gy*TILE
 
-def generate_static_dungeon():
-    rooms.clear()
-    room_data.clear()
-    room_doors.clear()
-    room_themes.clear()
+# Every room gets its own RNG derived from the run seed, so a room comes
+# out the same whether it is generated first, last or never.
+def room_rng(seed, room_index):
+    return random.Random(f"{seed}/{room_index}")
 
-    for i in range(ROOM_COUNT):
-        g, d = make_static_room(i)
-        rooms.append(g)
-        room_doors.append(d)
-        room_themes.append(ROOM_CONFIG[i]["theme"])
+def generate_room(dungeon, i, rng):
+    cfg = room_config(dungeon, i, rng)
+    g, doors = make_static_room(dungeon.neighbors[i], extra_walls(i, rng))
+
+    walls = list_walls(g)
+    free = FreeCells(g, rng)
+
+    enemies = []
+    chests = []
 
-    for i in range(ROOM_COUNT):
-        g = rooms[i]
-        cfg = ROOM_CONFIG[i]
+    for _ in range(rng.randint(cfg["enemy_min"], cfg["enemy_max"])):
+        x, y = free.take()
+        kind = rng.choice(cfg["enemy_types"])
+        enemies.append(Enemy(x, y, kind))
 
-        walls = list_walls(g)
-        placed = [pygame.Rect(wx, wy, TILE, TILE) for wx, wy in walls]
+    if not cfg["no_chests"]:
+        for _ in range(rng.randint(1,3)):
+            x, y = free.take()
+            items = [rng.choice(ITEM_ORDER) for _ in range(rng.randint(1,3))]
+            chests.append(Chest(x, y, items))
 
-        enemies = []
-        chests = []
+    return g, doors, cfg["theme"], (walls, enemies, chests)
 
-        for _ in range(random.randint(cfg["enemy_min"], cfg["enemy_max"])):
-            x, y = random_free(g, placed)
-            kind = random.choice(cfg["enemy_types"])
-            e = Enemy(x, y, kind)
-            enemies.append(e)
-            placed.append(e.rect)
+def generate_static_dungeon(dungeon):
+    rooms = []
+    room_data = []
+    room_doors = []
+    room_themes = []
 
-        if not cfg["no_chests"]:
-            for _ in range(random.randint(1,3)):
-                x, y = random_free(g, placed)
-                items = [random.choice(ITEM_ORDER) for _ in range(random.randint(1,3))]
-                c = Chest(x, y, items)
-                chests.append(c)
-                placed.append(c.rect)
+    for i in range(dungeon.room_count):
+        g, d, theme, data = generate_room(dungeon, i, room_rng(dungeon.seed, i))
+        rooms.append(g)
+        room_doors.append(d)
+        room_themes.append(theme)
+        room_data.append(data)
 
-        room_data.append((walls, enemies, chests))
+    return rooms, room_doors, room_themes, room_data
+
+# Dict of per-room values that generates a room the first time any of its
+# values is looked up. load(i) is expected to fill in self[i].
+class LazyRooms(dict):
+    def __init__(self, load):
+        super().__init__()
+        self.load = load
+
+    def __missing__(self, i):
+        self.load(i)
+        return self[i]
 
 # ---------------------------------------
 # ENTITY CLASSES
 # ---------------------------------------
+# Player and Enemy keep one Rect each and move it to (int(x), int(y)) when
+# .rect is read, instead of allocating a new one per access. The returned
+# Rect is shared, so callers that keep it past the current frame must copy.
 class Player:
+    __slots__ = ("x", "y", "prev_x", "prev_y", "speed", "mask", "width", "height",
+                 "max_health", "health", "invuln_until", "alive", "attacking",
+                 "attack_angle", "attack_end_time", "_rect")
+
     def __init__(self):
         self.x = TILE*2
         self.y = TILE*2
+        self.prev_x = self.x
+        self.prev_y = self.y
         self.speed = PLAYER_SPEED
         self.mask = player_mask
         self.width = player_img.get_width()
@@ -285,15 +903,18 @@ class Player:
         self.attacking = False
         self.attack_angle = 0
         self.attack_end_time = 0
+        self._rect = Rect(int(self.x), int(self.y), self.width, self.height)
 
     @property
     def center(self):
-        r = self.rect
-        return r.centerx, r.centery
+        return int(self.x) + self.width//2, int(self.y) + self.height//2
 
     @property
     def rect(self):
-        return pygame.Rect(int(self.x), int(self.y), self.width, self.height)
+        r = self._rect
+        r.x = int(self.x)
+        r.y = int(self.y)
+        return r
 
     def move(self, dx, dy, walls, grid):
         if dx==0 and dy==0 or not self.alive:
@@ -301,16 +922,9 @@ class Player:
         l = math.hypot(dx,dy)
         dx/=l
         dy/=l
-        ox, oy = self.x, self.y
-        self.x += dx*self.speed
-        self.y += dy*self.speed
-
-        for wx,wy in walls:
-            if pixel_collision(self, wx,wy, wall_mask):
-                self.x, self.y = ox, oy
-                break
+        swept_collision(self, dx*self.speed, dy*self.speed, grid)
 
-    def start_attack(self, mpos):
+    def start_attack(self, mpos, now):
         if not self.alive:
             return
         px, py = self.center
@@ -322,10 +936,10 @@ class Player:
             return
         self.attacking = True
         self.attack_angle = angle_between(dx,dy)
-        self.attack_end_time = pygame.time.get_ticks()+SWORD_SWING_MS
+        self.attack_end_time = now+SWORD_SWING_MS
 
-    def update_attack(self):
-        if self.attacking and pygame.time.get_ticks()>=self.attack_end_time:
+    def update_attack(self, now):
+        if self.attacking and now>=self.attack_end_time:
             self.attacking = False
 
     def can_hit(self, e):
@@ -341,8 +955,7 @@ class Player:
         diff = abs(angle_diff(angle_between(dx,dy), self.attack_angle))
         return diff<=SWORD_ARC_DEG/2
 
-    def take_damage(self, dmg):
-        now = pygame.time.get_ticks()
+    def take_damage(self, dmg, now):
         if now<self.invuln_until:
             return
         self.health -= dmg
@@ -355,22 +968,28 @@ class Player:
     def heal(self, amt):
         self.health = min(self.health+amt, self.max_health)
 
-    def draw(self,s):
-        s.blit(player_img, (int(self.x), int(self.y)))
+    def draw(self,s,alpha=1.0):
+        x = int(lerp(self.prev_x, self.x, alpha))
+        y = int(lerp(self.prev_y, self.y, alpha))
+        r = s.blit(player_img, (x, y))
         if self.attacking:
-            px,py = self.center
-            angle = -self.attack_angle
-            rot = pygame.transform.rotate(sword_img, angle)
-            rad = math.radians(self.attack_angle)
-            ox = px + math.cos(rad)*28 - rot.get_width()/2
-            oy = py + math.sin(rad)*28 - rot.get_height()/2
-            s.blit(rot, (ox,oy))
+            px,py = x + self.width//2, y + self.height//2
+            rot, ox, oy = rotations.get(sword_img, self.attack_angle, 28)
+            r.union_ip(s.blit(rot, (px+ox,py+oy)))
+        return r
 
 class Enemy:
+    __slots__=("x","y","prev_x","prev_y","kind","kind_id","behaviour","img","mask","speed","hp",
+               "contact_damage","width","height","next_shot","_rect")
+
     def __init__(self,x,y,kind):
         self.x=float(x)
         self.y=float(y)
+        self.prev_x=self.x
+        self.prev_y=self.y
         self.kind=kind
+        self.kind_id=ENEMY_IDS[kind]
+        self.behaviour=ENEMY_BEHAVIOUR[self.kind_id]
         self.img=enemy_images[kind]
         self.mask=enemy_masks[kind]
         s=ENEMY_STATS[kind]
@@ -380,15 +999,18 @@ class Enemy:
         self.width=self.img.get_width()
         self.height=self.img.get_height()
         self.next_shot=0
+        self._rect=Rect(int(self.x),int(self.y),self.width,self.height)
 
     @property
     def center(self):
-        r=self.rect
-        return r.centerx, r.centery
+        return int(self.x)+self.width//2, int(self.y)+self.height//2
 
     @property
     def rect(self):
-        return pygame.Rect(int(self.x), int(self.y), self.width,self.height)
+        r=self._rect
+        r.x=int(self.x)
+        r.y=int(self.y)
+        return r
 
     def alive(self):
         return self.hp>0
@@ -396,7 +1018,7 @@ class Enemy:
     def take_damage(self,v):
         self.hp-=v
 
-    def update(self,p, walls, grid, projectiles):
+    def update(self,p, walls, grid, projectiles, now, flow=None):
         if not self.alive() or not p.alive:
             return
         px,py=p.center
@@ -407,7 +1029,7 @@ class Enemy:
         if d==0:
             return
 
-        if self.kind=="eye":
+        if self.behaviour==SHOOTER:
             minr,maxr=160,260
             mx=my=0
             if d>maxr:
@@ -420,26 +1042,46 @@ class Enemy:
             self.x+=mx*self.speed
             self.y+=my*self.speed
 
-            for wx,wy in walls:
-                if pixel_collision(self,wx,wy,wall_mask):
-                    self.x,self.y=ox,oy
-                    break
+            if wall_collision(self,grid):
+                self.x,self.y=ox,oy
 
-            now=pygame.time.get_ticks()
             if d<=FIREBALL_RANGE and now>=self.next_shot:
                 self.shoot(px,py,projectiles)
                 self.next_shot=now+FIREBALL_COOLDOWN_MS
         else:
+            # walkers follow the room's flow field around pillars
+            hop=None
+            if flow is not None and self.behaviour!=PHASER:
+                hop=flow.next_hop(ex,ey)
+            if hop is not None:
+                hx=hop[0]-ex
+                hy=hop[1]-ey
+                hd=math.hypot(hx,hy)
+                if hd!=0:
+                    dx,dy,d=hx,hy,hd
+                else:
+                    hop=None
             mx=dx/d
             my=dy/d
             ox,oy=self.x,self.y
             self.x+=mx*self.speed
             self.y+=my*self.speed
-            if self.kind!="ghost":
-                for wx,wy in walls:
-                    if pixel_collision(self,wx,wy,wall_mask):
-                        self.x,self.y=ox,oy
-                        break
+            if self.behaviour!=PHASER and wall_collision(self,grid):
+                self.x,self.y=ox,oy
+                if hop is not None:
+                    self.slide(mx,my,grid)
+
+    # Try the blocked move one axis at a time so path followers slip past
+    # a pillar corner instead of stopping dead against it.
+    def slide(self,mx,my,grid):
+        ox=self.x
+        self.x+=mx*self.speed
+        if wall_collision(self,grid):
+            self.x=ox
+        oy=self.y
+        self.y+=my*self.speed
+        if wall_collision(self,grid):
+            self.y=oy
 
     def shoot(self,tx,ty,projectiles):
         ex,ey=self.center
@@ -447,46 +1089,226 @@ class Enemy:
         d=math.hypot(dx,dy)
         dx/=d
         dy/=d
-        projectiles.append(Fireball(ex,ey,dx*FIREBALL_SPEED,dy*FIREBALL_SPEED))
+        projectiles.spawn(ex,ey,dx*FIREBALL_SPEED,dy*FIREBALL_SPEED)
 
-    def draw(self,s):
+    def draw(self,s,alpha=1.0):
         if self.alive():
-            s.blit(self.img,(int(self.x),int(self.y)))
+            return s.blit(self.img,(int(lerp(self.prev_x,self.x,alpha)),
+                                    int(lerp(self.prev_y,self.y,alpha))))
+
+# ---------------------------------------
+# ENEMY BATCH (NUMPY)
+# ---------------------------------------
+# Horde rooms update their enemies as one struct-of-arrays batch instead of
+# one Enemy.update call each. Only enemies whose padded box touches a wall
+# tile after moving go through the per-enemy mask test, and eyes still fire
+# through Enemy.shoot, so the result matches Enemy.update exactly.
+BATCH_MIN_ENEMIES = 32
+
+class EnemyBatch:
+    def __init__(self, enemies):
+        self.enemies = enemies
+        n = len(enemies)
+        self.x = np.fromiter((e.x for e in enemies), float, n)
+        self.y = np.fromiter((e.y for e in enemies), float, n)
+        self.hp = np.fromiter((e.hp for e in enemies), int, n)
+        self.speed = np.fromiter((e.speed for e in enemies), float, n)
+        self.behaviour = np.fromiter((e.behaviour for e in enemies), int, n)
+        self.next_shot = np.fromiter((e.next_shot for e in enemies), float, n)
+        self.w = np.fromiter((e.width for e in enemies), int, n)
+        self.h = np.fromiter((e.height for e in enemies), int, n)
+
+    def update(self, p, grid, projectiles, now, flow=None):
+        if not p.alive:
+            return
+        px, py = p.center
+        ex = np.trunc(self.x).astype(int) + self.w//2
+        ey = np.trunc(self.y).astype(int) + self.h//2
+        dx = px - ex
+        dy = py - ey
+        d = np.sqrt(dx*dx + dy*dy)
+        active = (self.hp > 0) & (d != 0)
+        eye = self.behaviour == SHOOTER
+
+        if flow is not None:
+            hop_x, hop_y = flow.hop_arrays()
+            gx = ex//TILE
+            gy = ey//TILE
+            inside = (gx >= 0) & (gx < ROOM_W) & (gy >= 0) & (gy < ROOM_H)
+            gx = np.where(inside, gx, 0)
+            gy = np.where(inside, gy, 0)
+            hx = hop_x[gy, gx]
+            hy = hop_y[gy, gx]
+            hdx = hx - ex
+            hdy = hy - ey
+            hd = np.sqrt(hdx*hdx + hdy*hdy)
+            walk = inside & (hx >= 0) & (hd != 0) & ~eye & (self.behaviour != PHASER)
+            dx = np.where(walk, hdx, dx)
+            dy = np.where(walk, hdy, dy)
+            d = np.where(walk, hd, d)
+        else:
+            walk = np.zeros(len(self.enemies), bool)
+
+        safe_d = np.where(active, d, 1.0)
+        mx = dx/safe_d
+        my = dy/safe_d
+
+        keep = eye & (d <= 260) & (d >= 160)
+        flee = eye & (d < 160)
+        mx = np.where(keep, 0.0, np.where(flee, -mx, mx))
+        my = np.where(keep, 0.0, np.where(flee, -my, my))
+        mx = np.where(active, mx, 0.0)
+        my = np.where(active, my, 0.0)
+
+        nx = self.x + mx*self.speed
+        ny = self.y + my*self.speed
+
+        # broad phase against the wall grid, narrow phase via wall_collision
+        walled = active & (self.behaviour != PHASER)
+        g = np.asarray(grid, dtype=bool)
+        x0 = np.clip(np.floor(nx-1)//TILE, 0, ROOM_W-1).astype(int)
+        y0 = np.clip(np.floor(ny-1)//TILE, 0, ROOM_H-1).astype(int)
+        x1 = np.clip(np.floor(nx+self.w+1)//TILE, 0, ROOM_W-1).astype(int)
+        y1 = np.clip(np.floor(ny+self.h+1)//TILE, 0, ROOM_H-1).astype(int)
+        near = g[y0, x0] | g[y0, x1] | g[y1, x0] | g[y1, x1] | (x1-x0 > 1) | (y1-y0 > 1)
+
+        moved = np.flatnonzero(active)
+        nxl = nx.tolist()
+        nyl = ny.tolist()
+        for i in moved.tolist():
+            e = self.enemies[i]
+            ox, oy = e.x, e.y
+            e.x, e.y = nxl[i], nyl[i]
+            if walled[i] and near[i] and wall_collision(e, grid):
+                e.x, e.y = ox, oy
+                if walk[i]:
+                    e.slide(float(mx[i]), float(my[i]), grid)
+
+        shooters = np.flatnonzero(active & eye & (d <= FIREBALL_RANGE) & (now >= self.next_shot))
+        for i in shooters.tolist():
+            e = self.enemies[i]
+            e.shoot(px, py, projectiles)
+            e.next_shot = now+FIREBALL_COOLDOWN_MS
+
+def update_enemies(enemies, p, walls, grid, projectiles, now, flow=None):
+    for e in enemies:
+        e.prev_x = e.x
+        e.prev_y = e.y
+    if np is not None and len(enemies) >= BATCH_MIN_ENEMIES:
+        EnemyBatch(enemies).update(p, grid, projectiles, now, flow)
+        return
+    for e in enemies:
+        e.update(p, walls, grid, projectiles, now, flow)
 
 class Fireball:
-    def __init__(self,x,y,vx,vy):
+    __slots__=("x","y","prev_x","prev_y","vx","vy","r","alive","swept")
+
+    def __init__(self,x=0.0,y=0.0,vx=0.0,vy=0.0):
         self.x=x
         self.y=y
+        self.prev_x=x
+        self.prev_y=y
         self.vx=vx
         self.vy=vy
         self.r=8
         self.alive=True
+        self.swept=False
 
     @property
     def rect(self):
-        return pygame.Rect(int(self.x)-self.r,int(self.y)-self.r,self.r*2,self.r*2)
-
-    def update(self,grid,player):
-        if not self.alive:
-            return
-        self.x+=self.vx
-        self.y+=self.vy
-        if not (0<=self.x<=SCREEN_WIDTH and 0<=self.y<=SCREEN_HEIGHT):
-            self.alive=False
-            return
-        gx=int(self.x)//TILE
-        gy=int(self.y)//TILE
-        if 0<=gx<ROOM_W and 0<=gy<ROOM_H and grid[gy][gx]==1:
-            self.alive=False
-            return
-        if player.alive and self.rect.colliderect(player.rect):
-            player.take_damage(FIREBALL_DAMAGE)
-            self.alive=False
+        return Rect(int(self.x)-self.r,int(self.y)-self.r,self.r*2,self.r*2)
 
-    def draw(self,s):
+    def draw(self,s,alpha=1.0):
         if self.alive:
-            s.blit(fireball_img,(int(self.x)-fireball_img.get_width()//2,
-                                 int(self.y)-fireball_img.get_height()//2))
+            return s.blit(fireball_img,(int(lerp(self.prev_x,self.x,alpha))-fireball_img.get_width()//2,
+                                 int(lerp(self.prev_y,self.y,alpha))-fireball_img.get_height()//2))
+
+# Fixed-capacity store for a run's fireballs. All Fireball objects are
+# allocated up front; the live ones are kept packed at the front of
+# self.items in spawn order and dead ones are recycled in place, so bullet
+# heavy rooms allocate nothing per shot. Spawns past capacity are dropped.
+FIREBALL_POOL_SIZE = 1024
+
+class FireballPool:
+    def __init__(self,capacity=FIREBALL_POOL_SIZE):
+        self.items=[Fireball() for _ in range(capacity)]
+        self.count=0
+        self.peak=0
+        self.spawned=0
+        self.dropped=0
+
+    @property
+    def capacity(self):
+        return len(self.items)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.items[:self.count])
+
+    def clear(self):
+        self.count=0
+
+    def spawn(self,x,y,vx,vy):
+        if self.count==len(self.items):
+            self.dropped+=1
+            return None
+        fb=self.items[self.count]
+        fb.x=fb.prev_x=x; fb.y=fb.prev_y=y; fb.vx=vx; fb.vy=vy; fb.alive=True
+        # fast enough to skip over part of a tile in one tick: trace the whole path
+        fb.swept=max(abs(vx),abs(vy))>SWEEP_STEP
+        self.count+=1
+        self.spawned+=1
+        if self.count>self.peak:
+            self.peak=self.count
+        return fb
+
+    # Moves every live fireball and runs its screen, wall and player tests
+    # in one pass, compacting survivors to the front as it goes. others are
+    # any further players in the room (multiplayer).
+    def update(self,grid,player,now,others=()):
+        items=self.items
+        pr=player.rect
+        pl,pt,pr_,pb=pr.left,pr.top,pr.right,pr.bottom
+        others=[(q,q.rect.copy()) for q in others if q.alive]
+        keep=0
+        for k in range(self.count):
+            fb=items[k]
+            fb.prev_x=fb.x
+            fb.prev_y=fb.y
+            fb.x+=fb.vx
+            fb.y+=fb.vy
+            x=fb.x; y=fb.y
+            if not (0<=x<=SCREEN_WIDTH and 0<=y<=SCREEN_HEIGHT):
+                fb.alive=False
+                continue
+            ix=int(x); iy=int(y)
+            gx=ix//TILE
+            gy=iy//TILE
+            if fb.swept:
+                if segment_hits_wall(fb.prev_x,fb.prev_y,x,y,grid):
+                    fb.alive=False
+                    continue
+            elif 0<=gx<ROOM_W and 0<=gy<ROOM_H and grid[gy][gx]==1:
+                fb.alive=False
+                continue
+            r=fb.r
+            if player.alive and ix-r<pr_ and pl<ix+r and iy-r<pb and pt<iy+r:
+                player.take_damage(FIREBALL_DAMAGE,now)
+                fb.alive=False
+                continue
+            if others:
+                for q,qr in others:
+                    if ix-r<qr.right and qr.left<ix+r and iy-r<qr.bottom and qr.top<iy+r:
+                        q.take_damage(FIREBALL_DAMAGE,now)
+                        fb.alive=False
+                        break
+                if not fb.alive:
+                    continue
+            items[k],items[keep]=items[keep],fb
+            keep+=1
+        self.count=keep
 
 class Chest:
     def __init__(self,x,y,items):
@@ -494,7 +1316,7 @@ class Chest:
         self.y=y
         self.items=items
         self.open=False
-        self.rect=pygame.Rect(x,y,chest_img.get_width(),chest_img.get_height())
+        self.rect=Rect(x,y,chest_img.get_width(),chest_img.get_height())
 
     def try_open(self,p_rect,inv):
         if self.open or not p_rect.colliderect(self.rect):
@@ -504,31 +1326,27 @@ class Chest:
         self.open=True
 
     def draw(self,s):
-        s.blit(chest_open_img if self.open else chest_img,(self.x,self.y))
+        return s.blit(chest_open_img if self.open else chest_img,(self.x,self.y))
 
 
 # ---------------------------------------
-# GLOBAL GAME STATE
+# DRAW HELPERS
 # ---------------------------------------
-player=None
-current_room=0
-projectiles=[]
-inventory={}
+# Rendered text keyed by (text, font, colour). HUD counts and screen titles
+# come from a small fixed set of strings, so this never grows large.
+text_cache = {}
 
-def reset_run():
-    global player, current_room, projectiles, inventory
-    generate_static_dungeon()
-    player=Player()
-    current_room=0
-    projectiles=[]
-    inventory={n:0 for n in ITEM_ORDER}
+def render_text(font,text,colour):
+    key=(text,font,colour)
+    t=text_cache.get(key)
+    if t is None:
+        t=text_cache[key]=font.render(text,True,colour)
+    return t
 
-# ---------------------------------------
-# DRAW HELPERS
-# ---------------------------------------
 def draw_hearts(s,p):
     x=10;y=10
     sp=heart_full.get_width()+4
+    r=Rect(x,y,0,0)
     for i in range(p.max_health//2):
         idx=i*2
         if p.health>=idx+2:
@@ -537,217 +1355,1506 @@ def draw_hearts(s,p):
             img=heart_half
         else:
             img=heart_empty
-        s.blit(img,(x+i*sp,y))
+        r.union_ip(s.blit(img,(x+i*sp,y)))
+    return r
 
-def draw_inventory(s):
+def draw_inventory(s,inv):
     x=SCREEN_WIDTH-10
     y=10
+    r=Rect(x,y,0,0)
     for i,name in enumerate(ITEM_ORDER):
         img=item_images[name]
         ix=x-img.get_width()
         iy=y+i*26
-        s.blit(img,(ix,iy))
-        s.blit(hud_font.render(f"x{inventory[name]}",True,(255,255,255)),
-               (ix-35,iy+4))
-
-def draw_room(s,i):
-    grid=rooms[i]
-    theme=room_themes[i]
-    tile=library_wall_img if theme=="library" else wall_img
-    for y in range(ROOM_H):
-        for x in range(ROOM_W):
-            px=x*TILE; py=y*TILE
-            if grid[y][x]==0:
-                s.blit(floor_img,(px,py))
-            else:
-                s.blit(tile,(px,py))
+        r.union_ip(s.blit(img,(ix,iy)))
+        r.union_ip(s.blit(render_text(hud_font,f"x{inv[name]}",(255,255,255)),
+                          (ix-35,iy+4)))
+    return r
+
+# Hearts and item counts pre-composited into their own surfaces, redrawn
+# only when the player's health or the inventory counts change.
+class HudLayer:
+    def __init__(self):
+        self.key=None
+        self.parts=[]
+
+    def draw(self,s,p,inv):
+        key=(p.health,p.max_health,tuple(inv[n] for n in ITEM_ORDER))
+        if key!=self.key:
+            self.key=key
+            scratch=pygame.Surface((SCREEN_WIDTH,SCREEN_HEIGHT),pygame.SRCALPHA)
+            self.parts=[]
+            for r in (draw_hearts(scratch,p),draw_inventory(scratch,inv)):
+                self.parts.append((scratch.subsurface(r).copy(),r.topleft))
+        return [s.blit(img,pos) for img,pos in self.parts]
+
+hud = HudLayer()
+
+# The translucent backdrop behind the game over / win text, built once.
+dim_surface = None
+
+def draw_overlay(s,title,colour,info):
+    global dim_surface
+    if dim_surface is None:
+        dim_surface=pygame.Surface((SCREEN_WIDTH,SCREEN_HEIGHT),pygame.SRCALPHA)
+        dim_surface.fill((0,0,0,180))
+    s.blit(dim_surface,(0,0))
+    t=render_text(title_font,title,colour)
+    i=render_text(info_font,info,(230,230,230))
+    s.blit(t,(SCREEN_WIDTH//2-t.get_width()//2,SCREEN_HEIGHT//2-20))
+    s.blit(i,(SCREEN_WIDTH//2-i.get_width()//2,SCREEN_HEIGHT//2+30))
+
+# Room grids never change once generated, so each room's tile layer is
+# rendered once and reused. Cleared whenever a new dungeon is generated.
+room_bg_cache = {}
+
+def room_background(i,grid,theme):
+    key=(i,theme)
+    bg=room_bg_cache.get(key)
+    if bg is None:
+        bg=pygame.Surface((ROOM_W*TILE,ROOM_H*TILE))
+        if pygame.display.get_surface() is not None:
+            bg=bg.convert()
+        tile=library_wall_img if theme=="library" else wall_img
+        for y in range(ROOM_H):
+            for x in range(ROOM_W):
+                px=x*TILE; py=y*TILE
+                if grid[y][x]==0:
+                    bg.blit(floor_img,(px,py))
+                else:
+                    bg.blit(tile,(px,py))
+        room_bg_cache[key]=bg
+    return bg
+
+def draw_room(s,i,grid,theme):
+    s.blit(room_background(i,grid,theme),(0,0))
+
+# Draws everything on top of the room tiles and returns the touched rects.
+def draw_sprites(s,sim,alpha=1.0):
+    _,enemies,chests = sim.room_data[sim.current_room]
+    rects=[]
+    for c in chests: rects.append(c.draw(s))
+    for e in enemies: rects.append(e.draw(s,alpha))
+    for fb in sim.projectiles: rects.append(fb.draw(s,alpha))
+    for q in sim.others: rects.append(q.draw(s,alpha))
+    rects.append(sim.player.draw(s,alpha))
+    rects=[r for r in rects if r is not None]
+    profiler.lap("entities")
+    rects.extend(hud.draw(s,sim.player,sim.inventory))
+    if profiler.enabled:
+        rects.append(profiler.draw(s))
+    profiler.lap("hud")
+    return rects
+
+# Dirty-rectangle renderer for the play screen. After a full redraw it only
+# restores the room background under last frame's sprites, draws this
+# frame's sprites and pushes both sets of rects to the display.
+class DirtyRenderer:
+    def __init__(self):
+        self.room=None
+        self.prev=[]
+
+    def invalidate(self):
+        self.room=None
+
+    def draw(self,s,sim,alpha=1.0):
+        i=sim.current_room
+        bg=room_background(i,sim.rooms[i],sim.room_themes[i])
+        profiler.start()
+        if self.room!=i:
+            s.blit(bg,(0,0))
+            profiler.lap("draw_room")
+            self.prev=draw_sprites(s,sim,alpha)
+            self.room=i
+            pygame.display.flip()
+            profiler.lap("flip")
+            return
+        for r in self.prev:
+            s.blit(bg,r,r)
+        profiler.lap("draw_room")
+        rects=draw_sprites(s,sim,alpha)
+        pygame.display.update(self.prev+rects)
+        profiler.lap("flip")
+        self.prev=rects
 
 # ---------------------------------------
 # DAMAGE HANDLING
 # ---------------------------------------
-def handle_melee(p,enemies):
+def handle_melee(p,enemies,now,hits=None):
     if not p.alive:
         return
-    for e in enemies:
-        if e.alive() and e.kind!="eye" and p.rect.colliderect(e.rect):
-            p.take_damage(e.contact_damage)
-
-def handle_sword(p,enemies):
+    if hits is None:
+        hits=SpatialHash(enemies)
+    r=p.rect
+    for i in hits.query_rect(r):
+        e=enemies[i]
+        if e.alive() and e.behaviour!=SHOOTER and r.colliderect(e.rect):
+            p.take_damage(e.contact_damage,now)
+
+def handle_sword(p,enemies,hits=None):
     if not p.attacking:
         return
-    for e in enemies:
+    if hits is None:
+        hits=SpatialHash(enemies)
+    px,py=p.center
+    for i in hits.query_radius(px,py,SWORD_RANGE_PIXELS):
+        e=enemies[i]
         if e.alive() and p.can_hit(e):
             e.take_damage(SWORD_DAMAGE)
 
 # ---------------------------------------
 # ROOM TRANSITIONS (THE FIXED VERSION)
 # ---------------------------------------
-def try_room_transition():
-    global current_room
+def try_room_transition(player, current_room, room_doors, dungeon):
     r = player.rect
     doors = room_doors[current_room]
 
     # NORTH (center-based)
     if "N" in doors and r.colliderect(doors["N"]):
-        t = NEIGHBORS[current_room]["N"]
+        t = dungeon.neighbors[current_room]["N"]
         if t is not None:
             current_room = t
             d = room_doors[t]["S"]
             player.x = d.centerx - player.width//2
             player.y = d.top - player.height - 4
-        return
+        return current_room
 
     # SOUTH
     if "S" in doors and r.colliderect(doors["S"]):
-        t = NEIGHBORS[current_room]["S"]
+        t = dungeon.neighbors[current_room]["S"]
         if t is not None:
             current_room = t
             d = room_doors[t]["N"]
             player.x = d.centerx - player.width//2
             player.y = d.bottom + 4
-        return
+        return current_room
 
     # EAST (NO SCREEN EDGE CHECK — DOOR ONLY)
     if "E" in doors and r.colliderect(doors["E"]):
-        t = NEIGHBORS[current_room]["E"]
+        t = dungeon.neighbors[current_room]["E"]
         if t is not None:
             current_room = t
-
-            if t == FINAL_ROOM_INDEX:
-                # guaranteed safe open floor
-                player.x = TILE * 3
-                player.y = TILE * 3
-            else:
-                d = room_doors[t]["W"]
-                player.x = d.right + 4
-                player.y = d.centery - player.height//2
-        return
+            d = room_doors[t]["W"]
+            player.x = d.right + 4
+            player.y = d.centery - player.height//2
+        return current_room
 
     # WEST (same fix — door only)
     if "W" in doors and r.colliderect(doors["W"]):
-        t = NEIGHBORS[current_room]["W"]
+        t = dungeon.neighbors[current_room]["W"]
         if t is not None:
             current_room = t
+            d = room_doors[t]["E"]
+            player.x = d.left - player.width - 4
+            player.y = d.centery - player.height//2
+        return current_room
 
-            if t == FINAL_ROOM_INDEX:
-                player.x = TILE * (ROOM_W-4)
-                player.y = TILE * 3
-            else:
-                d = room_doors[t]["E"]
-                player.x = d.left - player.width - 4
-                player.y = d.centery - player.height//2
-        return
+    return current_room
 
 # ---------------------------------------
-# MAIN LOOP
+# WORLD TICK (OFF-SCREEN ROOMS)
 # ---------------------------------------
-running=True
-reset_run()
+# Rooms the player has left keep living at a lower level of detail: for
+# WANDER_STEPS steps of OFFSCREEN_INTERVAL ticks after the player leaves,
+# a room's enemies wander about its interior, on the tile grid only (no
+# pixel collision, no chasing, no fireballs), and then settle. Step j's
+# heading only depends on the seed, the room, the enemy and the frame the
+# step covers, so a room's state is a function of how it was left and of
+# the clock: saves store the room as it was left (see room_states) and the
+# steps are replayed when it is loaded. The scheduler takes the wandering
+# rooms round-robin and stops once a tick's budget of enemy steps is spent;
+# a room it doesn't reach is behind, not changed, and is caught up before
+# the player walks back in. The budget is counted in steps rather than
+# milliseconds so that replays stay deterministic.
+OFFSCREEN_INTERVAL = 6
+OFFSCREEN_BUDGET = 40
+WANDER_STEPS = 30*TICK_RATE//OFFSCREEN_INTERVAL
+WANDER_SPEED = 0.5
+WANDER_PERIOD = 2*TICK_RATE
+WANDER_DIRS = [(0, 0)] + [(math.cos(a*math.pi/4), math.sin(a*math.pi/4)) for a in range(8)]
+
+# Heading of enemy k in room i for the current WANDER_PERIOD. Hashed from
+# the run seed instead of kept per enemy, so saves need nothing extra.
+def wander_dir(seed, i, k, period):
+    return WANDER_DIRS[zlib.crc32(struct.pack("<IIHI", seed, i, k, period)) % len(WANDER_DIRS)]
+
+# Whether a w x h box at (x, y) touches a wall tile, the border ring (where
+# the door lanes are) or anything outside the room.
+def wander_blocked(x, y, w, h, grid):
+    x0 = math.floor(x)//TILE
+    y0 = math.floor(y)//TILE
+    x1 = (math.ceil(x+w)-1)//TILE
+    y1 = (math.ceil(y+h)-1)//TILE
+    if x0 < 1 or y0 < 1 or x1 > ROOM_W-2 or y1 > ROOM_H-2:
+        return True
+    for gy in range(y0, y1+1):
+        row = grid[gy]
+        for gx in range(x0, x1+1):
+            if row[gx] == 1:
+                return True
+    return False
+
+# Steps first .. first+count-1 of room i's wander since it was left at frame left.
+def wander_room(sim, i, left, first, count):
+    grid = sim.rooms[i]
+    _, enemies, _ = sim.room_data[i]
+    for j in range(first, first+count):
+        period = (left + j*OFFSCREEN_INTERVAL)//WANDER_PERIOD
+        for k, e in enumerate(enemies):
+            wx, wy = wander_dir(sim.seed, i, k, period)
+            step = OFFSCREEN_INTERVAL*WANDER_SPEED*e.speed
+            if not wander_blocked(e.x + wx*step, e.y, e.width, e.height, grid):
+                e.x += wx*step
+            if not wander_blocked(e.x, e.y + wy*step, e.width, e.height, grid):
+                e.y += wy*step
+    for e in enemies:
+        e.prev_x = e.x
+        e.prev_y = e.y
 
-while running:
-    dt = clock.tick(FPS)
+class WorldTicker:
+    def __init__(self):
+        self.left = {}          # room -> frame its wander started from
+        self.rest = {}          # room -> its room bytes (see encode_room) at that frame
+        self.done = {}          # room -> wander steps taken since
+        self.active = deque()   # rooms still wandering, in round-robin order
+
+    # Room i goes off-screen as it is now (it was just generated or left).
+    def leave(self, sim, i):
+        self.resume(i, encode_room(sim.room_data[i], sim.frame), sim.frame)
+
+    # Room i was left at frame left in the state raw (from a save).
+    def resume(self, i, raw, left):
+        self.left[i] = left
+        self.rest[i] = raw
+        self.done[i] = 0
+        if i not in self.active:
+            self.active.append(i)
+
+    # Takes up to limit of room i's due steps; returns how many it took.
+    def advance(self, sim, i, limit):
+        due = min((sim.frame - self.left[i])//OFFSCREEN_INTERVAL, WANDER_STEPS)
+        count = min(due - self.done[i], limit)
+        if count <= 0:
+            return 0
+        wander_room(sim, i, self.left[i], self.done[i], count)
+        self.done[i] += count
+        return count
+
+    # The player walks into room i: bring it fully up to date first.
+    def enter(self, sim, i):
+        if i in self.left:
+            self.advance(sim, i, WANDER_STEPS)
+        if i in self.active:
+            self.active.remove(i)
+
+    def tick(self, sim):
+        spent = 0
+        for _ in range(len(self.active)):
+            if spent >= OFFSCREEN_BUDGET:
+                return
+            i = self.active.popleft()
+            n = len(sim.room_data[i][1])
+            if i == sim.current_room or not n:
+                continue
+            spent += self.advance(sim, i, max((OFFSCREEN_BUDGET - spent)//n, 1))*n
+            if self.done[i] < WANDER_STEPS:
+                self.active.append(i)
 
-    for ev in pygame.event.get():
-        if ev.type==pygame.QUIT:
-            running=False
+# ---------------------------------------
+# SIMULATION
+# ---------------------------------------
+# One frame of player input. dx/dy are -1/0/1 like the keyboard axes,
+# attack is a mouse position (or None), use lists item names to eat.
+class Inputs:
+    def __init__(self,dx=0,dy=0,attack=None,use=(),open_chests=False):
+        self.dx=dx
+        self.dy=dy
+        self.attack=attack
+        self.use=use
+        self.open_chests=open_chests
+
+# Owns a whole run and advances it one fixed tick at a time. Nothing here
+# draws or reads pygame events, so it can be stepped headless as fast as it
+# goes. All timers run on the simulation clock (now), never on wall time.
+class Simulation:
+    def __init__(self,seed=None,room_count=ROOM_COUNT):
+        load_assets()
+        self.rng=random.Random(seed)
+        self.room_count=room_count
+        self.reset()
+
+    # Rooms are only generated when something first looks at them (usually
+    # try_room_transition reading the target room's doors), so a restart
+    # costs one room instead of the whole dungeon.
+    def reset(self,seed=None):
+        self.seed=self.rng.getrandbits(32) if seed is None else seed
+        self.dungeon=Dungeon(self.seed,self.room_count)
+        self.rooms=LazyRooms(self.load_room)
+        self.room_doors=LazyRooms(self.load_room)
+        self.room_themes=LazyRooms(self.load_room)
+        self.room_data=LazyRooms(self.load_room)
+        self.player=Player()
+        self.current_room=0
+        self.projectiles=FireballPool()
+        self.inventory={n:0 for n in ITEM_ORDER}
+        self.state="play"
+        self.frame=0
+        self.flow=FlowField()
+        self.world=WorldTicker()
+        # other players in the current room; only a multiplayer client has any
+        self.others=[]
+        # saved room states (see restore) waiting for their room to be generated
+        self.pending_rooms={}
+
+    def load_room(self,i):
+        if not 0<=i<self.dungeon.room_count:
+            raise KeyError(i)
+        g, doors, theme, data = generate_room(self.dungeon, i, room_rng(self.seed, i))
+        dict.__setitem__(self.rooms, i, g)
+        dict.__setitem__(self.room_doors, i, doors)
+        dict.__setitem__(self.room_themes, i, theme)
+        dict.__setitem__(self.room_data, i, data)
+        saved=self.pending_rooms.pop(i,None)
+        if saved is None:
+            self.world.leave(self,i)
+        else:
+            self.world.resume(i,saved,decode_room(saved,data))
 
-        if game_state=="title":
-            if ev.type==pygame.KEYDOWN and ev.key in (pygame.K_RETURN, pygame.K_SPACE):
-                reset_run()
-                game_state="play"
+    @property
+    def now(self):
+        return self.frame*1000//TICK_RATE
 
-        elif game_state=="play":
-            if ev.type==pygame.MOUSEBUTTONDOWN and ev.button==1:
-                player.start_attack(pygame.mouse.get_pos())
-                _,enemy_set,_ = room_data[current_room]
-                handle_sword(player, enemy_set)
+    def use_item(self,name):
+        if self.inventory[name]>0:
+            self.inventory[name]-=1
+            self.player.heal(item_heal[name])
 
-            if ev.type==pygame.KEYDOWN:
-                if ev.key==pygame.K_1 and inventory["apple"]>0:
-                    inventory["apple"]-=1; player.heal(item_heal["apple"])
-                if ev.key==pygame.K_2 and inventory["bread"]>0:
-                    inventory["bread"]-=1; player.heal(item_heal["bread"])
-                if ev.key==pygame.K_3 and inventory["meat"]>0:
-                    inventory["meat"]-=1; player.heal(item_heal["meat"])
-                if ev.key==pygame.K_4 and inventory["chicken"]>0:
-                    inventory["chicken"]-=1; player.heal(item_heal["chicken"])
+    def step(self,inputs):
+        if self.state!="play":
+            return
+        self.frame+=1
+        now=self.now
+        player=self.player
+        player.prev_x=player.x
+        player.prev_y=player.y
+
+        if inputs.attack is not None:
+            player.start_attack(inputs.attack,now)
+
+        for name in inputs.use:
+            self.use_item(name)
+
+        if inputs.open_chests:
+            _,_,chs = self.room_data[self.current_room]
+            for c in chs:
+                c.try_open(player.rect, self.inventory)
+        profiler.lap("events")
+
+        walls, enemies, chests = self.room_data[self.current_room]
+
+        player.move(inputs.dx,inputs.dy,walls,self.rooms[self.current_room])
+        profiler.lap("move")
+        room=self.current_room
+        self.current_room=try_room_transition(player,room,self.room_doors,self.dungeon)
+        if self.current_room!=room:
+            player.prev_x=player.x
+            player.prev_y=player.y
+            self.world.leave(self,room)
+            self.world.enter(self,self.current_room)
+        player.update_attack(now)
+        profiler.lap("transition")
+
+        grid=self.rooms[self.current_room]
+        walls, enemies, chests = self.room_data[self.current_room]
+        cx,cy=player.center
+        self.flow.update(grid,cx//TILE,cy//TILE)
+        update_enemies(enemies,player,walls,grid,self.projectiles,now,self.flow)
 
-                if ev.key==pygame.K_e:
-                    _,_,chs = room_data[current_room]
-                    for c in chs:
-                        c.try_open(player.rect, inventory)
-
-        elif game_state in ("gameover","win"):
-            if ev.type==pygame.KEYDOWN and ev.key in (pygame.K_RETURN, pygame.K_SPACE):
-                reset_run(); game_state="play"
-
-    if game_state=="title":
-        screen.fill((0,0,0))
-        t = title_font.render("Dungeon Explorer",True,(255,255,255))
-        i = info_font.render("Press Enter to Start",True,(200,200,200))
-        screen.blit(t,(SCREEN_WIDTH//2-t.get_width()//2, SCREEN_HEIGHT//2-40))
-        screen.blit(i,(SCREEN_WIDTH//2-i.get_width()//2, SCREEN_HEIGHT//2+20))
-        pygame.display.flip()
-        continue
+        enemies[:] = [e for e in enemies if e.alive()]
+        profiler.lap("enemies")
+        # one hash per tick: a swing started this tick lands on the enemies
+        # where they are now, before they get their contact hits in
+        hits=SpatialHash(enemies)
+        if inputs.attack is not None:
+            handle_sword(player, enemies, hits)
+        handle_melee(player, enemies, now, hits)
+        profiler.lap("melee")
 
-    if game_state=="play":
-        keys=pygame.key.get_pressed()
-        dx=(keys[pygame.K_d] or keys[pygame.K_RIGHT]) - (keys[pygame.K_a] or keys[pygame.K_LEFT])
-        dy=(keys[pygame.K_s] or keys[pygame.K_DOWN]) - (keys[pygame.K_w] or keys[pygame.K_UP])
+        self.projectiles.update(grid,player,now)
+        profiler.lap("projectiles")
+
+        self.world.tick(self)
+        profiler.lap("world")
+
+        if not player.alive:
+            self.state="gameover"
+
+        if self.current_room==self.dungeon.final_room and all(not e.alive() for e in enemies):
+            self.state="win"
 
-        walls, enemies, chests = room_data[current_room]
+# ---------------------------------------
+# REPLAYS
+# ---------------------------------------
+# A replay is the run seed plus, for every tick, the Inputs fed to
+# Simulation.step and a CRC of the resulting state. Since the simulation is
+# deterministic, re-stepping those inputs headless must reproduce every
+# hash. Layout (little endian):
+#   header  "DGRP", version u8, room_count u32, seed u32
+#   tick    flags u8 (dx+1: 2 bits, dy+1: 2 bits, attack, open chests, use)
+#           [attack x u16, y u16] [use count u8, item index u8 * count]
+#           state crc u32
+REPLAY_MAGIC = b"DGRP"
+REPLAY_VERSION = 2
+REPLAY_HEADER = struct.Struct("<4sBII")
+
+def state_hash(sim):
+    p=sim.player
+    _,enemies,chests=sim.room_data[sim.current_room]
+    vals=[sim.frame,sim.current_room,p.x,p.y,p.health,p.invuln_until,
+          p.attacking,p.attack_end_time]
+    vals.extend(sim.inventory[n] for n in ITEM_ORDER)
+    for e in enemies:
+        vals.extend((e.x,e.y,e.hp,e.next_shot))
+    for c in chests:
+        vals.append(c.open)
+    for fb in sim.projectiles:
+        vals.extend((fb.x,fb.y))
+    return zlib.crc32(struct.pack(f"<{len(vals)}d",*vals))
+
+def encode_inputs(inputs):
+    flags=(inputs.dx+1)|(inputs.dy+1)<<2
+    extra=b""
+    if inputs.attack is not None:
+        flags|=16
+        x,y=inputs.attack
+        extra+=struct.pack("<HH",min(max(int(x),0),65535),min(max(int(y),0),65535))
+    if inputs.open_chests:
+        flags|=32
+    if inputs.use:
+        flags|=64
+        extra+=bytes([len(inputs.use)])+bytes(ITEM_ORDER.index(n) for n in inputs.use)
+    return bytes([flags])+extra
+
+# Reads encode_inputs() bytes at offset k. Returns the Inputs and the offset
+# just past them.
+def decode_inputs(data,k):
+    flags=data[k]; k+=1
+    inputs=Inputs(dx=(flags&3)-1,dy=(flags>>2&3)-1,open_chests=bool(flags&32))
+    if flags&16:
+        inputs.attack=struct.unpack_from("<HH",data,k); k+=4
+    if flags&64:
+        n=data[k]
+        inputs.use=[ITEM_ORDER[i] for i in data[k+1:k+1+n]]
+        k+=1+n
+    return inputs,k
+
+class Recorder:
+    def __init__(self,sim):
+        self.data=bytearray(REPLAY_HEADER.pack(REPLAY_MAGIC,REPLAY_VERSION,sim.room_count,sim.seed))
+        self.frames=0
+
+    # call right after sim.step(inputs)
+    def record(self,inputs,sim):
+        self.data+=encode_inputs(inputs)
+        self.data+=struct.pack("<I",state_hash(sim))
+        self.frames+=1
+
+    def save(self,path):
+        with open(path,"wb") as f:
+            f.write(self.data)
+
+def read_replay(path):
+    with open(path,"rb") as f:
+        data=f.read()
+    magic,version,room_count,seed=REPLAY_HEADER.unpack_from(data)
+    if magic!=REPLAY_MAGIC or version!=REPLAY_VERSION:
+        raise ValueError(f"{path} is not a version {REPLAY_VERSION} replay")
+    ticks=[]
+    k=REPLAY_HEADER.size
+    while k<len(data):
+        inputs,k=decode_inputs(data,k)
+        ticks.append((inputs,struct.unpack_from("<I",data,k)[0]))
+        k+=4
+    return seed,room_count,ticks
+
+# Re-runs a replay headless as fast as possible. Returns the number of the
+# first tick whose state hash differs, or None when the whole run matches.
+def verify_replay(path):
+    seed,room_count,ticks=read_replay(path)
+    sim=Simulation(room_count=room_count)
+    sim.reset(seed)
+    for n,(inputs,expected) in enumerate(ticks):
+        sim.step(inputs)
+        if state_hash(sim)!=expected:
+            return n
+    return None
 
-        player.move(dx,dy,walls,rooms[current_room])
-        try_room_transition()
-        player.update_attack()
+# ---------------------------------------
+# SAVES
+# ---------------------------------------
+# A save is a snapshot of one run. Room layouts come back from the seed, so
+# only what play changes is stored: the player, inventory, fireballs and,
+# for every room generated so far, its enemies and which chests are open.
+# Off-screen rooms are stored as the player left them; their wander since
+# follows from that (see WORLD TICK). A delta save names the full save it
+# builds on (by CRC) and only carries the rooms whose state differs from
+# it, which for an autosave is usually just the current one. Layout
+# (little endian):
+#   header  "DGSV", version u8, delta u8, base crc u32, room_count u32, seed u32
+#   run     frame u32, state u8, current room u32, player,
+#           inventory u8 * items, fireball count u16, (x, y, vx, vy f64) * count
+#   rooms   count u32, (index u32, length u16, room bytes) * count
+#   crc u32 of everything before it
+# Room bytes are the frame the room was left at u32, an enemy count u16, (kind u8,
+# x f64, y f64, hp i16, next shot u32) * count, a chest count u8 and the
+# chests' open bits.
+SAVE_MAGIC = b"DGSV"
+SAVE_VERSION = 4
+SAVE_HEADER = struct.Struct("<4sBBIII")
+SAVE_RUN = struct.Struct("<IBI")
+SAVE_PLAYER = struct.Struct("<ddhhIBBdI")
+SAVE_FIREBALL = struct.Struct("<dddd")
+SAVE_ENEMY = struct.Struct("<Bddhi")
+SAVE_STATES = ("play","gameover","win")
+
+def encode_room(data,clock):
+    _,enemies,chests=data
+    out=bytearray(struct.pack("<IH",clock,len(enemies)))
+    for e in enemies:
+        out+=SAVE_ENEMY.pack(e.kind_id,e.x,e.y,e.hp,e.next_shot)
+    bits=sum(1<<k for k,c in enumerate(chests) if c.open)
+    out.append(len(chests))
+    out+=bits.to_bytes((len(chests)+7)//8,"little")
+    return bytes(out)
+
+def decode_room(raw,data):
+    _,enemies,chests=data
+    clock,n=struct.unpack_from("<IH",raw)
+    k=6
+    enemies.clear()
+    for _ in range(n):
+        kind,x,y,hp,next_shot=SAVE_ENEMY.unpack_from(raw,k)
+        k+=SAVE_ENEMY.size
+        e=Enemy(x,y,ENEMY_KINDS[kind])
+        e.hp=hp
+        e.next_shot=next_shot
+        enemies.append(e)
+    count=raw[k]
+    bits=int.from_bytes(raw[k+1:k+1+(count+7)//8],"little")
+    for j,c in enumerate(chests):
+        c.open=bool(bits>>j&1)
+    return clock
+
+# Room bytes for every room the run knows about, generated or still pending.
+def room_states(sim):
+    rooms=dict(sim.pending_rooms)
+    rooms.update(sim.world.rest)
+    i=sim.current_room
+    rooms[i]=encode_room(sim.room_data[i],sim.frame)
+    return rooms
+
+def snapshot(sim,base=None):
+    rooms=room_states(sim)
+    base_crc=0
+    if base is not None:
+        base_crc=zlib.crc32(base)
+        old=read_save(base)[2]
+        rooms={i:b for i,b in rooms.items() if old.get(i)!=b}
+
+    p=sim.player
+    out=bytearray(SAVE_HEADER.pack(SAVE_MAGIC,SAVE_VERSION,base is not None,base_crc,
+                                   sim.room_count,sim.seed))
+    out+=SAVE_RUN.pack(sim.frame,SAVE_STATES.index(sim.state),sim.current_room)
+    out+=SAVE_PLAYER.pack(p.x,p.y,p.health,p.max_health,p.invuln_until,p.alive,
+                          p.attacking,p.attack_angle,p.attack_end_time)
+    out+=bytes(sim.inventory[n] for n in ITEM_ORDER)
+    out+=struct.pack("<H",len(sim.projectiles))
+    for fb in sim.projectiles:
+        out+=SAVE_FIREBALL.pack(fb.x,fb.y,fb.vx,fb.vy)
+    out+=struct.pack("<I",len(rooms))
+    for i,raw in sorted(rooms.items()):
+        out+=struct.pack("<IH",i,len(raw))+raw
+    out+=struct.pack("<I",zlib.crc32(out))
+    return bytes(out)
+
+# Splits a save into its header fields, the run section and the room bytes.
+def read_save(data):
+    if len(data)<SAVE_HEADER.size+4 or zlib.crc32(data[:-4])!=struct.unpack_from("<I",data,len(data)-4)[0]:
+        raise ValueError("save is truncated or corrupt")
+    magic,version,delta,base_crc,room_count,seed=SAVE_HEADER.unpack_from(data)
+    if magic!=SAVE_MAGIC or version!=SAVE_VERSION:
+        raise ValueError(f"not a version {SAVE_VERSION} save")
+    k=SAVE_HEADER.size+SAVE_RUN.size+SAVE_PLAYER.size+len(ITEM_ORDER)
+    k+=2+struct.unpack_from("<H",data,k)[0]*SAVE_FIREBALL.size
+    run=data[SAVE_HEADER.size:k]
+    rooms={}
+    n,=struct.unpack_from("<I",data,k)
+    k+=4
+    for _ in range(n):
+        i,size=struct.unpack_from("<IH",data,k)
+        rooms[i]=data[k+6:k+6+size]
+        k+=6+size
+    return (delta,base_crc,room_count,seed),run,rooms
+
+# Puts sim back into the saved state. A delta needs the full save it was
+# taken against. Rooms are only decoded once something generates them.
+def restore(sim,data,base=None):
+    (delta,base_crc,room_count,seed),run,rooms=read_save(data)
+    if delta:
+        if base is None or zlib.crc32(base)!=base_crc:
+            raise ValueError("delta save does not match its base save")
+        base_rooms=read_save(base)[2]
+        base_rooms.update(rooms)
+        rooms=base_rooms
+
+    sim.room_count=room_count
+    sim.reset(seed)
+    sim.pending_rooms=rooms
+    frame,state,sim.current_room=SAVE_RUN.unpack_from(run)
+    sim.frame=frame
+    sim.state=SAVE_STATES[state]
+    p=sim.player
+    (p.x,p.y,p.health,p.max_health,p.invuln_until,alive,attacking,
+     p.attack_angle,p.attack_end_time)=SAVE_PLAYER.unpack_from(run,SAVE_RUN.size)
+    p.alive=bool(alive)
+    p.attacking=bool(attacking)
+    p.prev_x=p.x
+    p.prev_y=p.y
+    k=SAVE_RUN.size+SAVE_PLAYER.size
+    for j,n in enumerate(ITEM_ORDER):
+        sim.inventory[n]=run[k+j]
+    k+=len(ITEM_ORDER)
+    count,=struct.unpack_from("<H",run,k)
+    k+=2
+    for _ in range(count):
+        sim.projectiles.spawn(*SAVE_FIREBALL.unpack_from(run,k))
+        k+=SAVE_FIREBALL.size
+
+# Where saves live. The web build has no persistent file system, so there
+# they go to the browser's localStorage (base64 encoded) through the
+# window object pygbag exposes as platform.window.
+SAVE_DIR = "saves"
+
+def write_blob(name,data):
+    if sys.platform=="emscripten":
+        import base64, platform
+        platform.window.localStorage.setItem(name,base64.b64encode(data).decode())
+        return
+    os.makedirs(SAVE_DIR,exist_ok=True)
+    tmp=os.path.join(SAVE_DIR,name+".tmp")
+    with open(tmp,"wb") as f:
+        f.write(data)
+    os.replace(tmp,os.path.join(SAVE_DIR,name))
+
+def read_blob(name):
+    if sys.platform=="emscripten":
+        import base64, platform
+        text=platform.window.localStorage.getItem(name)
+        return None if text is None else base64.b64decode(str(text))
+    try:
+        with open(os.path.join(SAVE_DIR,name),"rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def delete_blob(name):
+    if sys.platform=="emscripten":
+        import platform
+        platform.window.localStorage.removeItem(name)
+        return
+    try:
+        os.remove(os.path.join(SAVE_DIR,name))
+    except FileNotFoundError:
+        pass
+
+# One save slot: a full save plus at most one delta on top of it. Autosaves
+# write deltas until one grows past half the full save or the run changes,
+# then write a fresh full save.
+class SaveSlot:
+    def __init__(self,name="slot1"):
+        self.name=name
+        self.base=None
+
+    def exists(self):
+        return read_blob(self.name+".sav") is not None
+
+    def save(self,sim,full=False):
+        base=self.base
+        if base is not None and not full and read_save(base)[0][3]==sim.seed:
+            data=snapshot(sim,base)
+            if len(data)*2<=len(base):
+                write_blob(self.name+".delta",data)
+                return data
+        data=self.base=snapshot(sim)
+        write_blob(self.name+".sav",data)
+        delete_blob(self.name+".delta")
+        return data
+
+    def clear(self):
+        self.base=None
+        delete_blob(self.name+".sav")
+        delete_blob(self.name+".delta")
+
+    def load(self,sim):
+        base=read_blob(self.name+".sav")
+        if base is None:
+            return False
+        delta=read_blob(self.name+".delta")
+        try:
+            restore(sim,delta if delta is not None else base,base)
+        except ValueError:
+            # a delta left behind by an older full save: fall back to the full one
+            try:
+                restore(sim,base)
+            except ValueError:
+                return False
+        self.base=base
+        return True
 
-        walls, enemies, chests = room_data[current_room]
+# ---------------------------------------
+# NETWORK (MULTIPLAYER)
+# ---------------------------------------
+# The server owns the only real game state: it steps every connected
+# Player against the shared room_data and a fireball pool per room, while
+# clients send their Inputs and draw what comes back. Messages are u16
+# length-prefixed over TCP. On joining (and at every new round) a client
+# gets a welcome with its player id and the run seed, and generates the
+# room layouts itself from the seed, so snapshots only carry what moves.
+#
+# Snapshots are room scoped: a client only hears about the players,
+# enemies, fireballs and chests of the room it is in. Positions are
+# quantized to quarter pixels (fireballs to whole pixels) and sword angles
+# to 256 steps. Players and enemies are delta coded against the last
+# snapshot sent to that client, with a bit mask per entity saying which
+# fields follow; TCP delivers every snapshot in order, so the last one sent
+# is always the one the client holds. Entering a room resets that to a full
+# snapshot. Layout (little endian):
+#   welcome   type u8, player id u8, seed u32, room_count u32
+#   snapshot  type u8, tick u32, full u8, room u32, state u8,
+#             inventory u8 * items, chest bits u8, players, enemies,
+#             fireball count u16, (x i16, y i16) * count
+#             players and enemies are: changed u16, (id u16, mask u8,
+#             changed fields) * changed, removed u16, id u16 * removed
+#   inputs    type u8, encode_inputs() bytes
+NET_PORT = 7777
+NET_SNAPSHOT_TICKS = 2          # 30 snapshots a second
+NET_RESTART_TICKS = 3*TICK_RATE
+NET_MAX_PLAYERS = 256           # player ids are a u8
+NET_MAX_PENDING = 8             # event-carrying Inputs kept per client per tick
+NET_MAX_BACKLOG = 64*1024       # bytes queued for a client before it counts as stalled
+NET_WELCOME = 1
+NET_SNAPSHOT = 2
+NET_INPUTS = 3
+NET_WELCOME_MSG = struct.Struct("<BBII")
+NET_SNAPSHOT_HEAD = struct.Struct("<BIBIB")
+NET_FIREBALL = struct.Struct("<hh")
+# x, y, health, max health, sword angle (255 when not swinging)
+NET_PLAYER_FIELDS = [struct.Struct("<"+f) for f in "HHBBB"]
+# kind, x, y, hp
+NET_ENEMY_FIELDS = [struct.Struct("<"+f) for f in "BHHB"]
+
+def quantize(v):
+    return min(max(int(v*4),0),65535)
+
+def net_player(p):
+    angle=int(p.attack_angle%360*256/360)%256 if p.attacking else 255
+    return (quantize(p.x),quantize(p.y),min(max(p.health,0),255),min(p.max_health,255),angle)
+
+def net_enemy(e):
+    return (e.kind_id,quantize(e.x),quantize(e.y),min(max(int(e.hp),0),255))
+
+def encode_delta(out,old,new,fields):
+    changed=[(k,v) for k,v in new.items() if old.get(k)!=v]
+    out+=struct.pack("<H",len(changed))
+    for k,v in changed:
+        o=old.get(k)
+        mask=0
+        body=bytearray()
+        for j,f in enumerate(fields):
+            if o is None or o[j]!=v[j]:
+                mask|=1<<j
+                body+=f.pack(v[j])
+        out+=struct.pack("<HB",k,mask)+body
+    removed=[k for k in old if k not in new]
+    out+=struct.pack(f"<H{len(removed)}H",len(removed),*removed)
+
+# Applies an encode_delta() section at offset k to table (id -> fields).
+# Returns the offset just past it.
+def decode_delta(data,k,table,fields):
+    n,=struct.unpack_from("<H",data,k); k+=2
+    for _ in range(n):
+        key,mask=struct.unpack_from("<HB",data,k); k+=3
+        vals=list(table.get(key,(0,)*len(fields)))
+        for j,f in enumerate(fields):
+            if mask>>j&1:
+                vals[j],=f.unpack_from(data,k); k+=f.size
+        table[key]=tuple(vals)
+    n,=struct.unpack_from("<H",data,k); k+=2
+    for key in struct.unpack_from(f"<{n}H",data,k):
+        table.pop(key,None)
+    return k+2*n
+
+# The Inputs in a client's message, or None when it isn't a well formed
+# inputs message: a bad message gets its sender dropped rather than
+# anything out of range reaching the simulation.
+def net_inputs(data):
+    if len(data)<2 or data[0]!=NET_INPUTS:
+        return None
+    try:
+        inputs,k=decode_inputs(data,1)
+    except (IndexError,struct.error):
+        return None
+    if k!=len(data) or not (-1<=inputs.dx<=1 and -1<=inputs.dy<=1):
+        return None
+    return inputs
+
+def net_send(writer,data):
+    writer.write(struct.pack("<H",len(data))+data)
+
+async def net_recv(reader):
+    n,=struct.unpack("<H",await reader.readexactly(2))
+    return await reader.readexactly(n)
+
+# One connected player on the server.
+class Peer:
+    def __init__(self,pid,writer):
+        self.pid=pid
+        self.writer=writer
+        self.bytes_sent=0
+        self.respawn()
+
+    def respawn(self):
+        self.player=Player()
+        self.room=0
+        self.inventory={n:0 for n in ITEM_ORDER}
+        self.state="play"
+        self.dx=self.dy=0
+        self.pending=[]         # Inputs whose attack/use/open parts are still to apply
+        self.sent_room=None
+        self.sent_players={}
+        self.sent_enemies={}
+
+class GameServer:
+    def __init__(self,seed=None,room_count=ROOM_COUNT):
+        # rooms, doors and enemies come from a Simulation; its own player is unused
+        self.sim=Simulation(seed,room_count)
+        self.peers={}
+        self.tick_ms=deque(maxlen=5*TICK_RATE)
+        self.port=None
+        self.new_round(self.sim.seed)
+
+    def new_round(self,seed=None):
+        self.sim.reset(seed)
+        self.pools={}
+        self.flows={}
+        self.net_ids={}         # id(enemy) -> net id
+        self.next_id=0
+        self.over_at=None
+        for peer in self.peers.values():
+            peer.respawn()
+            net_send(peer.writer,self.welcome(peer))
+
+    def welcome(self,peer):
+        return NET_WELCOME_MSG.pack(NET_WELCOME,peer.pid,self.sim.seed,self.sim.room_count)
+
+    # the player enemies in a room go after: the one nearest to the pack
+    def target(self,players,enemies):
+        if len(players)==1 or not enemies:
+            return players[0]
+        mx=sum(e.x for e in enemies)/len(enemies)
+        my=sum(e.y for e in enemies)/len(enemies)
+        return min(players,key=lambda p:(p.x-mx)**2+(p.y-my)**2)
+
+    def step(self):
+        sim=self.sim
+        sim.frame+=1
+        now=sim.now
+        swung=set()
+        for peer in self.peers.values():
+            p=peer.player
+            p.prev_x=p.x
+            p.prev_y=p.y
+            if peer.state!="play":
+                continue
+            walls,enemies,chests=sim.room_data[peer.room]
+            # one swing per tick at most, and none while one is under way,
+            # however many attack messages arrived
+            for inputs in peer.pending:
+                if inputs.attack is not None and not p.attacking:
+                    p.start_attack(inputs.attack,now)
+                    swung.add(p)
+                for name in inputs.use:
+                    if peer.inventory[name]>0:
+                        peer.inventory[name]-=1
+                        p.heal(item_heal[name])
+                if inputs.open_chests:
+                    for c in chests:
+                        c.try_open(p.rect,peer.inventory)
+            peer.pending.clear()
+            p.move(peer.dx,peer.dy,walls,sim.rooms[peer.room])
+            peer.room=try_room_transition(p,peer.room,sim.room_doors,sim.dungeon)
+            p.update_attack(now)
+
+        # only rooms someone is playing in are simulated
+        occupied={}
+        for peer in self.peers.values():
+            if peer.state=="play":
+                occupied.setdefault(peer.room,[]).append(peer.player)
+        for i,players in occupied.items():
+            grid=sim.rooms[i]
+            walls,enemies,chests=sim.room_data[i]
+            pool=self.pools.get(i)
+            if pool is None:
+                pool=self.pools[i]=FireballPool()
+            target=self.target(players,enemies)
+            cx,cy=target.center
+            flow=self.flows.setdefault(i,FlowField()).update(grid,cx//TILE,cy//TILE)
+            update_enemies(enemies,target,walls,grid,pool,now,flow)
+            for e in enemies:
+                if not e.alive():
+                    self.net_ids.pop(id(e),None)
+            enemies[:]=[e for e in enemies if e.alive()]
+            # one hash per room and tick, for this tick's swings and then
+            # the contact hits, as in Simulation.step
+            hits=SpatialHash(enemies)
+            for p in players:
+                if p in swung:
+                    handle_sword(p,enemies,hits)
+            for p in players:
+                handle_melee(p,enemies,now,hits)
+            pool.update(grid,target,now,[p for p in players if p is not target])
+        for i,pool in self.pools.items():
+            if i not in occupied:
+                pool.clear()
+
+        for peer in self.peers.values():
+            if peer.state=="play" and not peer.player.alive:
+                peer.state="gameover"
+        if self.over_at is None and self.peers:
+            final=sim.dungeon.final_room
+            result=None
+            if final in occupied and not sim.room_data[final][1]:
+                result="win"
+            elif all(peer.state!="play" for peer in self.peers.values()):
+                result="gameover"
+            if result:
+                for peer in self.peers.values():
+                    peer.state=result
+                self.over_at=sim.frame
+        elif self.over_at is not None and sim.frame-self.over_at>=NET_RESTART_TICKS:
+            self.new_round()
+
+    def snapshot(self,peer):
+        sim=self.sim
+        i=peer.room
+        full=peer.sent_room!=i
+        if full:
+            peer.sent_room=i
+            peer.sent_players={}
+            peer.sent_enemies={}
+        _,enemies,chests=sim.room_data[i]
+        players={q.pid:net_player(q.player) for q in self.peers.values() if q.room==i}
+        net_ids=self.net_ids
+        ens={}
         for e in enemies:
-            e.update(player,walls,rooms[current_room],projectiles)
+            k=net_ids.get(id(e))
+            if k is None:
+                k=net_ids[id(e)]=self.next_id
+                self.next_id=(self.next_id+1)%65536
+            ens[k]=net_enemy(e)
+
+        out=bytearray(NET_SNAPSHOT_HEAD.pack(NET_SNAPSHOT,sim.frame,full,i,SAVE_STATES.index(peer.state)))
+        out+=bytes(min(peer.inventory[n],255) for n in ITEM_ORDER)
+        out.append(sum(1<<k for k,c in enumerate(chests) if c.open))
+        encode_delta(out,peer.sent_players,players,NET_PLAYER_FIELDS)
+        encode_delta(out,peer.sent_enemies,ens,NET_ENEMY_FIELDS)
+        fireballs=list(self.pools.get(i,()))
+        out+=struct.pack("<H",len(fireballs))
+        for fb in fireballs:
+            out+=NET_FIREBALL.pack(int(fb.x),int(fb.y))
+        peer.sent_players=players
+        peer.sent_enemies=ens
+        return bytes(out)
+
+    async def handle(self,reader,writer):
+        pid=next((k for k in range(NET_MAX_PLAYERS) if k not in self.peers),None)
+        if pid is None:
+            # server full
+            writer.close()
+            return
+        peer=self.peers[pid]=Peer(pid,writer)
+        net_send(writer,self.welcome(peer))
+        try:
+            while True:
+                inputs=net_inputs(await net_recv(reader))
+                if inputs is None:
+                    break
+                peer.dx,peer.dy=inputs.dx,inputs.dy
+                events=inputs.attack is not None or inputs.use or inputs.open_chests
+                if events and len(peer.pending)<NET_MAX_PENDING:
+                    peer.pending.append(inputs)
+        except (asyncio.IncompleteReadError,ConnectionError):
+            pass
+        finally:
+            del self.peers[pid]
+            writer.close()
+
+    def stats(self):
+        ms=sorted(self.tick_ms) or [0.0]
+        return {"players":len(self.peers),"tick_ms_mean":sum(ms)/len(ms),"tick_ms_max":ms[-1],
+                "bytes_per_player":{p.pid:p.bytes_sent for p in self.peers.values()}}
+
+    # Steps at TICK_RATE and sends snapshots every NET_SNAPSHOT_TICKS, for
+    # ever or for the given number of ticks. port 0 picks a free port.
+    async def run(self,host="0.0.0.0",port=NET_PORT,ticks=None):
+        server=await asyncio.start_server(self.handle,host,port)
+        self.port=server.sockets[0].getsockname()[1]
+        next_tick=time.perf_counter()
+        n=0
+        async with server:
+            while ticks is None or n<ticks:
+                t=time.perf_counter()
+                self.step()
+                if self.sim.frame%NET_SNAPSHOT_TICKS==0:
+                    for peer in list(self.peers.values()):
+                        if peer.writer.is_closing():
+                            continue
+                        # a client that stopped reading is dropped instead
+                        # of having its snapshots buffered without end
+                        if peer.writer.transport.get_write_buffer_size()>NET_MAX_BACKLOG:
+                            peer.writer.transport.abort()
+                            continue
+                        data=self.snapshot(peer)
+                        net_send(peer.writer,data)
+                        peer.bytes_sent+=len(data)+2
+                self.tick_ms.append((time.perf_counter()-t)*1000)
+                n+=1
+                next_tick+=TICK_MS/1000
+                delay=next_tick-time.perf_counter()
+                if delay<-0.25:
+                    next_tick=time.perf_counter()  # too far behind to catch up
+                await asyncio.sleep(max(delay,0))
+
+# Client side: mirrors the server's view of our room into a Simulation that
+# is never stepped, so the normal renderer (and the balance bots) can use it.
+class NetClient:
+    def __init__(self):
+        self.view=Simulation()
+        self.pid=None
+        self.rounds=0
+        self.players={}         # pid -> quantized fields
+        self.enemies={}         # net id -> quantized fields
+        self.sprites={}         # pid -> Player, for the others in the room
+        self.enemy_objs={}      # net id -> Enemy
+        self.bytes_received=0
+        self.snapshot_time=time.perf_counter()
+
+    async def connect(self,host,port=NET_PORT):
+        self.reader,self.writer=await asyncio.open_connection(host,port)
+        self.apply(await net_recv(self.reader))
+
+    async def listen(self):
+        while True:
+            self.apply(await net_recv(self.reader))
+
+    def send(self,inputs):
+        net_send(self.writer,bytes([NET_INPUTS])+encode_inputs(inputs))
+
+    def close(self):
+        self.writer.close()
+
+    # how far the view is between the last two snapshots, for interpolation
+    def alpha(self):
+        return min((time.perf_counter()-self.snapshot_time)*1000/(NET_SNAPSHOT_TICKS*TICK_MS),1.0)
+
+    def apply(self,data):
+        self.bytes_received+=len(data)+2
+        if data[0]==NET_WELCOME:
+            _,self.pid,seed,room_count=NET_WELCOME_MSG.unpack_from(data)
+            self.view.room_count=room_count
+            self.view.reset(seed)
+            self.players={}
+            self.enemies={}
+            self.sprites={}
+            self.enemy_objs={}
+            self.rounds+=1
+        elif data[0]==NET_SNAPSHOT:
+            self.apply_snapshot(data)
+
+    def apply_snapshot(self,data):
+        v=self.view
+        _,tick,full,room,state=NET_SNAPSHOT_HEAD.unpack_from(data)
+        k=NET_SNAPSHOT_HEAD.size
+        if full:
+            self.players.clear()
+            self.enemies.clear()
+            self.sprites.clear()
+            self.enemy_objs.clear()
+        v.frame=tick
+        v.current_room=room
+        v.state=SAVE_STATES[state]
+        for j,n in enumerate(ITEM_ORDER):
+            v.inventory[n]=data[k+j]
+        k+=len(ITEM_ORDER)
+        bits=data[k]; k+=1
+        _,enemies,chests=v.room_data[room]
+        for j,c in enumerate(chests):
+            c.open=bool(bits>>j&1)
+        k=decode_delta(data,k,self.players,NET_PLAYER_FIELDS)
+        k=decode_delta(data,k,self.enemies,NET_ENEMY_FIELDS)
+        n,=struct.unpack_from("<H",data,k); k+=2
+        v.projectiles.clear()
+        for _ in range(n):
+            x,y=NET_FIREBALL.unpack_from(data,k); k+=NET_FIREBALL.size
+            v.projectiles.spawn(x,y,0.0,0.0)
+
+        others=[]
+        for pid,(x,y,health,max_health,angle) in self.players.items():
+            if pid==self.pid:
+                p=v.player
+            else:
+                p=self.sprites.get(pid)
+                if p is None:
+                    p=self.sprites[pid]=Player()
+                    p.x=x/4
+                    p.y=y/4
+                if health>0:
+                    others.append(p)
+            p.prev_x=x/4 if full else p.x
+            p.prev_y=y/4 if full else p.y
+            p.x=x/4
+            p.y=y/4
+            p.health=health
+            p.max_health=max_health
+            p.alive=health>0
+            p.attacking=angle!=255
+            p.attack_angle=angle*360/256
+        for pid in [pid for pid in self.sprites if pid not in self.players]:
+            del self.sprites[pid]
+        v.others=others
+
+        objs=self.enemy_objs
+        for key in [key for key in objs if key not in self.enemies]:
+            del objs[key]
+        for key,(kind,x,y,hp) in self.enemies.items():
+            e=objs.get(key)
+            if e is None:
+                e=objs[key]=Enemy(x/4,y/4,ENEMY_KINDS[kind])
+            e.prev_x=e.x
+            e.prev_y=e.y
+            e.x=x/4
+            e.y=y/4
+            e.hp=hp
+        enemies[:]=objs.values()
+        self.snapshot_time=time.perf_counter()
 
-        enemies[:] = [e for e in enemies if e.alive()]
-        handle_melee(player, enemies)
+# ---------------------------------------
+# MAIN LOOP
+# ---------------------------------------
+# number keys 1-9 use the items in inventory order, whatever the content defines
+ITEM_KEYS = {pygame.K_1+k: name for k, name in enumerate(ITEM_ORDER[:9])}
+AUTOSAVE_TICKS = 10*TICK_RATE
+LOAD_BUDGET_MS = 8    # title screen time per frame spent on prepare_run
+
+# Everything the first run needs, a step at a time so the title screen can
+# show (and the browser stay responsive) while it happens: the assets, then
+# the Simulation with its first room generated and prerendered. The finished
+# Simulation is the generator's return value.
+def prepare_run():
+    yield from load_asset_steps()
+    sim=Simulation()
+    yield
+    i=sim.current_room
+    room_background(i,sim.rooms[i],sim.room_themes[i])
+    return sim
+
+# Replays of successive runs go to path, path-2, path-3, ...
+def replay_path(path,run):
+    if run==1:
+        return path
+    stem,ext=os.path.splitext(path)
+    return f"{stem}-{run}{ext}"
+
+# Async so that under pygbag every frame hands control back to the browser.
+async def main(record=None):
+    init_display()
+
+    game_state="title"
+    preparing=prepare_run()
+    sim=None
+    # the prepared run hasn't been played yet, so Enter can start it as is
+    fresh=False
+    recorder=None
+    runs=0
+    renderer=DirtyRenderer()
+    running=True
+    acc=0.0
+    inputs=Inputs(use=[])
+    shown=None
+    slot=SaveSlot()
+    can_continue=slot.exists()
+
+    while running:
+        await asyncio.sleep(0)
+        dt = clock.tick(FPS)
+        profiler.end_frame(dt)
+        profiler.start()
+
+        for ev in pygame.event.get():
+            if ev.type==pygame.QUIT:
+                running=False
+                if game_state=="play":
+                    slot.save(sim,full=True)
+
+            if ev.type==pygame.KEYDOWN and ev.key==pygame.K_F3:
+                profiler.toggle()
+                renderer.invalidate()
+            if ev.type==pygame.KEYDOWN and ev.key==pygame.K_F4:
+                profiler.dump("profile.json")
+                profiler.dump("profile.csv")
+
+            if game_state=="title" and sim is not None:
+                if ev.type==pygame.KEYDOWN and ev.key in (pygame.K_RETURN, pygame.K_SPACE):
+                    if not fresh:
+                        sim.reset(); room_bg_cache.clear()
+                    fresh=False
+                    renderer.invalidate()
+                    acc=0.0
+                    game_state="play"
+                    if record:
+                        runs+=1
+                        recorder=Recorder(sim)
+                if ev.type==pygame.KEYDOWN and ev.key==pygame.K_c and can_continue:
+                    if slot.load(sim):
+                        room_bg_cache.clear()
+                        fresh=False
+                        renderer.invalidate()
+                        acc=0.0
+                        game_state=sim.state
+                    else:
+                        # unreadable save: stay on the title, without the option
+                        can_continue=False
+                        shown=None
+
+            elif game_state=="play":
+                if ev.type==pygame.MOUSEBUTTONDOWN and ev.button==1:
+                    inputs.attack=ev.pos
+
+                if ev.type==pygame.KEYDOWN:
+                    if ev.key in ITEM_KEYS:
+                        inputs.use.append(ITEM_KEYS[ev.key])
+                    if ev.key==pygame.K_e:
+                        inputs.open_chests=True
+                    if ev.key==pygame.K_F5:
+                        slot.save(sim)
+                    if ev.key==pygame.K_F9 and slot.load(sim):
+                        room_bg_cache.clear()
+                        renderer.invalidate()
+                        acc=0.0
+                        # a loaded run no longer follows the recorded inputs
+                        if recorder:
+                            recorder.save(replay_path(record,runs))
+                            recorder=None
+
+            elif game_state in ("gameover","win"):
+                if ev.type==pygame.KEYDOWN and ev.key in (pygame.K_RETURN, pygame.K_SPACE):
+                    sim.reset(); room_bg_cache.clear()
+                    renderer.invalidate()
+                    acc=0.0
+                    game_state="play"
+                    if record:
+                        runs+=1
+                        recorder=Recorder(sim)
+
+        # the title and end screens are static, so draw them only once
+        # (the title twice: while loading and when ready)
+        if game_state=="title":
+            title="title" if sim is not None else "loading"
+            if shown!=title:
+                screen.fill((0,0,0))
+                t = render_text(title_font,"Dungeon Explorer",(255,255,255))
+                i = render_text(info_font,"Press Enter to Start" if sim is not None else "Loading...",(200,200,200))
+                screen.blit(t,(SCREEN_WIDTH//2-t.get_width()//2, SCREEN_HEIGHT//2-40))
+                screen.blit(i,(SCREEN_WIDTH//2-i.get_width()//2, SCREEN_HEIGHT//2+20))
+                if can_continue and sim is not None:
+                    c = render_text(info_font,"Press C to Continue",(200,200,200))
+                    screen.blit(c,(SCREEN_WIDTH//2-c.get_width()//2, SCREEN_HEIGHT//2+56))
+                pygame.display.flip()
+                profiler.mark("first_frame")
+                shown=title
+            # prepare within a per-frame budget; the frame is already drawn
+            deadline=time.perf_counter()+LOAD_BUDGET_MS/1000
+            while sim is None and time.perf_counter()<deadline:
+                try:
+                    next(preparing)
+                except StopIteration as done:
+                    sim=done.value
+                    fresh=True
+                    profiler.mark("ready")
+            continue
 
-        for fb in projectiles:
-            fb.update(rooms[current_room],player)
-        projectiles[:] = [fb for fb in projectiles if fb.alive]
+        if game_state=="play":
+            keys=pygame.key.get_pressed()
+            inputs.dx=(keys[pygame.K_d] or keys[pygame.K_RIGHT]) - (keys[pygame.K_a] or keys[pygame.K_LEFT])
+            inputs.dy=(keys[pygame.K_s] or keys[pygame.K_DOWN]) - (keys[pygame.K_w] or keys[pygame.K_UP])
+            profiler.lap("events")
+            # fixed-timestep accumulator: as many ticks as real time calls
+            # for (possibly none), capped so a long stall can't snowball
+            acc+=dt
+            ticks=0
+            while acc>=TICK_MS and ticks<MAX_TICKS_PER_FRAME and sim.state=="play":
+                sim.step(inputs)
+                if recorder:
+                    recorder.record(inputs,sim)
+                if sim.frame%AUTOSAVE_TICKS==0:
+                    slot.save(sim)
+                acc-=TICK_MS
+                ticks+=1
+                # clicks and key presses only apply to the first tick
+                inputs=Inputs(dx=inputs.dx,dy=inputs.dy,use=[])
+            if ticks==MAX_TICKS_PER_FRAME:
+                acc=min(acc,TICK_MS)
+            game_state=sim.state
+            if game_state!="play":
+                slot.clear()
+                can_continue=False
+            if recorder and game_state!="play":
+                recorder.save(replay_path(record,runs))
+                recorder=None
+
+        if game_state=="play":
+            renderer.draw(screen,sim,acc/TICK_MS)
+            shown="play"
+            continue
 
-        if not player.alive:
-            game_state="gameover"
-
-        if current_room==FINAL_ROOM_INDEX and all(not e.alive() for e in enemies):
-            game_state="win"
-
-    screen.fill((0,0,0))
-    draw_room(screen,current_room)
-
-    walls,enemies,chests = room_data[current_room]
-    for c in chests: c.draw(screen)
-    for e in enemies: e.draw(screen)
-    for fb in projectiles: fb.draw(screen)
-    player.draw(screen)
-
-    draw_hearts(screen,player)
-    draw_inventory(screen)
-
-    if game_state=="gameover":
-        o=pygame.Surface((SCREEN_WIDTH,SCREEN_HEIGHT),pygame.SRCALPHA)
-        o.fill((0,0,0,180))
-        screen.blit(o,(0,0))
-        t=title_font.render("You Died",True,(220,50,50))
-        i=info_font.render("Press Enter to Restart",True,(230,230,230))
-        screen.blit(t,(SCREEN_WIDTH//2-t.get_width()//2,SCREEN_HEIGHT//2-20))
-        screen.blit(i,(SCREEN_WIDTH//2-i.get_width()//2,SCREEN_HEIGHT//2+30))
-
-    if game_state=="win":
-        o=pygame.Surface((SCREEN_WIDTH,SCREEN_HEIGHT),pygame.SRCALPHA)
-        o.fill((0,0,0,180))
-        screen.blit(o,(0,0))
-        t=title_font.render("You Win!",True,(50,220,80))
-        i=info_font.render("Press Enter to Play Again",True,(230,230,230))
-        screen.blit(t,(SCREEN_WIDTH//2-t.get_width()//2,SCREEN_HEIGHT//2-20))
-        screen.blit(i,(SCREEN_WIDTH//2-i.get_width()//2,SCREEN_HEIGHT//2+30))
-
-    pygame.display.flip()
-
-pygame.quit()
+        if shown==game_state:
+            continue
+        shown=game_state
+        i=sim.current_room
+        draw_room(screen,i,sim.rooms[i],sim.room_themes[i])
+        draw_sprites(screen,sim)
+
+        if game_state=="gameover":
+            draw_overlay(screen,"You Died",(220,50,50),"Press Enter to Restart")
+
+        if game_state=="win":
+            draw_overlay(screen,"You Win!",(50,220,80),"Press Enter to Play Again")
+
+        renderer.invalidate()
+        pygame.display.flip()
+
+    if recorder:
+        recorder.save(replay_path(record,runs))
+    pygame.quit()
+
+# Client for a GameServer: sends the keyboard and mouse as Inputs and draws
+# whatever the server last said about our room.
+async def play_online(host,port=NET_PORT):
+    init_display()
+    load_assets()
+
+    client=NetClient()
+    await client.connect(host,port)
+    listener=asyncio.ensure_future(client.listen())
+    renderer=DirtyRenderer()
+    inputs=Inputs(use=[])
+    sent=None
+    rounds=None
+    shown=None
+    running=True
+
+    while running and not listener.done():
+        dt=clock.tick(FPS)
+        profiler.end_frame(dt)
+        profiler.start()
+        events=False
+        for ev in pygame.event.get():
+            if ev.type==pygame.QUIT:
+                running=False
+            if ev.type==pygame.KEYDOWN and ev.key==pygame.K_F3:
+                profiler.toggle()
+                renderer.invalidate()
+            if ev.type==pygame.MOUSEBUTTONDOWN and ev.button==1:
+                inputs.attack=ev.pos
+                events=True
+            if ev.type==pygame.KEYDOWN:
+                if ev.key in ITEM_KEYS:
+                    inputs.use.append(ITEM_KEYS[ev.key])
+                    events=True
+                if ev.key==pygame.K_e:
+                    inputs.open_chests=True
+                    events=True
+
+        keys=pygame.key.get_pressed()
+        inputs.dx=(keys[pygame.K_d] or keys[pygame.K_RIGHT]) - (keys[pygame.K_a] or keys[pygame.K_LEFT])
+        inputs.dy=(keys[pygame.K_s] or keys[pygame.K_DOWN]) - (keys[pygame.K_w] or keys[pygame.K_UP])
+        # only send when something changed; the server keeps the last direction
+        if events or (inputs.dx,inputs.dy)!=sent:
+            client.send(inputs)
+            sent=(inputs.dx,inputs.dy)
+            inputs=Inputs(use=[])
+        profiler.lap("events")
+
+        v=client.view
+        if client.rounds!=rounds:
+            rounds=client.rounds
+            room_bg_cache.clear()
+            renderer.invalidate()
+            shown=None
+        if v.state=="play":
+            renderer.draw(screen,v,client.alpha())
+            shown="play"
+        elif shown!=v.state:
+            shown=v.state
+            i=v.current_room
+            draw_room(screen,i,v.rooms[i],v.room_themes[i])
+            draw_sprites(screen,v)
+            if v.state=="gameover":
+                draw_overlay(screen,"You Died",(220,50,50),"Waiting for the next round")
+            else:
+                draw_overlay(screen,"You Win!",(50,220,80),"Next round starting")
+            renderer.invalidate()
+            pygame.display.flip()
+        await asyncio.sleep(0)
+
+    listener.cancel()
+    client.close()
+    pygame.quit()
+
+async def serve(port):
+    server=GameServer()
+    task=asyncio.ensure_future(server.run(port=port))
+    last={}
+    while not task.done():
+        await asyncio.sleep(5)
+        st=server.stats()
+        rates=[(b-last.get(pid,0))/5 for pid,b in st["bytes_per_player"].items()]
+        last=st["bytes_per_player"]
+        print(f"{st['players']} players  tick {st['tick_ms_mean']:.2f} ms (max {st['tick_ms_max']:.2f})"
+              f"  {sum(rates)/max(len(rates),1)/1024:.1f} KiB/s per player")
+    task.result()
+
+if __name__ == "__main__":
+    # python main.py                     play
+    # python main.py --record run.rpl    play and record each run
+    # python main.py --verify run.rpl    re-run a replay headless and check it
+    # python main.py --serve [PORT]      run a multiplayer server
+    # python main.py --connect HOST[:PORT]  join one
+    if len(sys.argv)==3 and sys.argv[1]=="--verify":
+        start=time.perf_counter()
+        bad=verify_replay(sys.argv[2])
+        took=time.perf_counter()-start
+        if bad is None:
+            print(f"{sys.argv[2]}: ok ({took:.2f}s)")
+        else:
+            print(f"{sys.argv[2]}: state diverged at tick {bad}")
+            sys.exit(1)
+    elif len(sys.argv)==3 and sys.argv[1]=="--record":
+        asyncio.run(main(record=sys.argv[2]))
+    elif len(sys.argv) in (2,3) and sys.argv[1]=="--serve":
+        asyncio.run(serve(int(sys.argv[2]) if len(sys.argv)==3 else NET_PORT))
+    elif len(sys.argv)==3 and sys.argv[1]=="--connect":
+        host,_,port=sys.argv[2].partition(":")
+        asyncio.run(play_online(host,int(port) if port else NET_PORT))
+    else:
+        asyncio.run(main())
@@ -0,0 +1,89 @@
+# Loopback load test for the multiplayer server.
+#
+#   python netbench.py --bots 16 --seconds 20
+#   python netbench.py --bots 8 --connect somehost:7777
+#
+# Starts a GameServer on a free local port (unless --connect names one) and
+# joins it with bot clients, each a NetClient whose view is driven by the
+# balance scripted bot. Reports the server's achieved tick rate and cost per
+# tick, and the bandwidth each player receives and sends.
+import argparse
+import asyncio
+import os
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import main
+import balance
+
+class BotClient:
+    def __init__(self, seed):
+        self.client = main.NetClient()
+        self.bot = balance.ScriptedBot(seed)
+        self.bytes_sent = 0
+
+    async def run(self, host, port, seconds):
+        client = self.client
+        await client.connect(host, port)
+        listener = asyncio.ensure_future(client.listen())
+        sent = None
+        end = time.perf_counter() + seconds
+        # decide once per snapshot, like a player reacting to what they see
+        while time.perf_counter() < end and not listener.done():
+            await asyncio.sleep(main.NET_SNAPSHOT_TICKS*main.TICK_MS/1000)
+            if client.view.state != "play":
+                continue
+            inputs = self.bot.act(client.view)
+            events = inputs.attack is not None or inputs.use or inputs.open_chests
+            if events or (inputs.dx, inputs.dy) != sent:
+                data = bytes([main.NET_INPUTS]) + main.encode_inputs(inputs)
+                main.net_send(client.writer, data)
+                self.bytes_sent += len(data) + 2
+                sent = (inputs.dx, inputs.dy)
+        listener.cancel()
+        client.close()
+
+async def bench(bots, seconds, host, port):
+    server = None
+    if port is None:
+        server = main.GameServer(seed=1)
+        task = asyncio.ensure_future(server.run(host="127.0.0.1", port=0))
+        while server.port is None:
+            await asyncio.sleep(0.01)
+        host, port = "127.0.0.1", server.port
+        start_frame = server.sim.frame
+
+    clients = [BotClient(k) for k in range(bots)]
+    start = time.perf_counter()
+    await asyncio.gather(*(c.run(host, port, seconds) for c in clients))
+    took = time.perf_counter() - start
+
+    print(f"{bots} bots for {took:.1f}s")
+    if server is not None:
+        st = server.stats()
+        ticks = server.sim.frame - start_frame
+        print(f"server   {ticks/took:.1f} ticks/s (target {main.TICK_RATE})  "
+              f"tick {st['tick_ms_mean']:.3f} ms mean, {st['tick_ms_max']:.3f} ms max")
+        task.cancel()
+    down = [c.client.bytes_received/took for c in clients]
+    up = [c.bytes_sent/took for c in clients]
+    print(f"download {sum(down)/len(down)/1024:.2f} KiB/s per player (max {max(down)/1024:.2f})")
+    print(f"upload   {sum(up)/len(up):.0f} B/s per player")
+    print(f"rounds   {max(c.client.rounds for c in clients)}")
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bots", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--connect", metavar="HOST:PORT", help="use a running server instead")
+    args = parser.parse_args()
+    host, port = "127.0.0.1", None
+    if args.connect:
+        host, _, port = args.connect.partition(":")
+        port = int(port) if port else main.NET_PORT
+    asyncio.run(bench(args.bots, args.seconds, host, port))
+
+if __name__ == "__main__":
+    main_cli()
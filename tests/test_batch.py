@@ -0,0 +1,53 @@
+# Lockstep check of the numpy enemy batch against the per-enemy updates.
+#
+#   python -m pytest tests
+import os
+import random
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import main
+
+pytestmark = pytest.mark.skipif(main.np is None, reason="the batch needs numpy")
+
+# A seeded room packed with enemies of every kind, well over BATCH_MIN_ENEMIES.
+def horde(seed, count=120):
+    sim = main.Simulation(seed=seed)
+    sim.player.max_health = sim.player.health = 10**9
+    grid = sim.rooms[0]
+    _, enemies, _ = sim.room_data[0]
+    rng = random.Random(seed)
+    while len(enemies) < count:
+        e = main.Enemy(rng.uniform(main.TILE, main.SCREEN_WIDTH - 2*main.TILE),
+                       rng.uniform(main.TILE, main.SCREEN_HEIGHT - 2*main.TILE),
+                       rng.choice(main.ENEMY_KINDS))
+        if not main.wall_collision(e, grid):
+            enemies.append(e)
+    return sim
+
+def random_inputs(rng):
+    return main.Inputs(dx=rng.choice((-1, 0, 1)), dy=rng.choice((-1, 0, 1)),
+                       attack=(rng.randint(0, main.SCREEN_WIDTH), rng.randint(0, main.SCREEN_HEIGHT))
+                              if rng.random() < 0.1 else None)
+
+@pytest.mark.parametrize("seed", range(3))
+def test_batch_matches_per_enemy_updates(seed, monkeypatch):
+    batched = horde(seed)
+    single = horde(seed)
+    rng = random.Random(seed)
+    for _ in range(600):
+        inputs = random_inputs(rng)
+        monkeypatch.setattr(main, "BATCH_MIN_ENEMIES", 32)
+        batched.step(inputs)
+        monkeypatch.setattr(main, "BATCH_MIN_ENEMIES", 10**9)
+        single.step(inputs)
+        assert main.state_hash(batched) == main.state_hash(single), batched.frame
+        if batched.state != "play" or batched.current_room != 0:
+            break
+    assert batched.frame > 60
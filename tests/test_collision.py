@@ -0,0 +1,134 @@
+# Side by side checks of the collision shortcuts against brute force.
+#
+#   python -m pytest tests
+import math
+import os
+import random
+import sys
+from fractions import Fraction
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import main
+
+def entities():
+    yield main.Player()
+    for kind in main.ENEMY_KINDS:
+        yield main.Enemy(0, 0, kind)
+
+@pytest.mark.parametrize("seed", range(8))
+def test_wall_collision_matches_every_wall_scan(seed):
+    sim = main.Simulation(seed=seed)
+    rng = random.Random(seed)
+    for i in range(sim.dungeon.room_count):
+        grid = sim.rooms[i]
+        walls = main.list_walls(grid)
+        for obj in entities():
+            for _ in range(200):
+                # sub-pixel positions all over the room, edges and door lanes included
+                obj.x = rng.uniform(-main.TILE, main.SCREEN_WIDTH)
+                obj.y = rng.uniform(-main.TILE, main.SCREEN_HEIGHT)
+                expected = any(main.pixel_collision(obj, wx, wy, main.wall_mask) for wx, wy in walls)
+                assert main.wall_collision(obj, grid) == expected, (i, obj.x, obj.y)
+
+@pytest.mark.parametrize("seed", range(4))
+def test_pixel_collision_matches_raw_mask_overlap(seed):
+    rng = random.Random(seed)
+    targets = [main.wall_mask, main.chest_mask] + [e.mask for e in entities()]
+    for obj in entities():
+        for tmask in targets:
+            w, h = tmask.get_size()
+            for _ in range(500):
+                obj.x = rng.uniform(0, 200)
+                obj.y = rng.uniform(0, 200)
+                tx = obj.x + rng.uniform(-w-2, obj.width+2)
+                ty = obj.y + rng.uniform(-h-2, obj.height+2)
+                expected = obj.mask.overlap(tmask, (int(tx-obj.x), int(ty-obj.y))) is not None
+                assert main.pixel_collision(obj, tx, ty, tmask) == expected, (tx-obj.x, ty-obj.y)
+
+def open_grid():
+    return [[0]*main.ROOM_W for _ in range(main.ROOM_H)]
+
+def test_swept_collision_cannot_jump_a_wall():
+    grid = open_grid()
+    for gy in range(main.ROOM_H):
+        grid[gy][12] = 1
+    for obj in entities():
+        for dx in range(main.TILE+obj.width, 5*main.TILE):
+            obj.x = 12*main.TILE - obj.width - 2
+            obj.y = 5*main.TILE + 3
+            assert main.swept_collision(obj, dx, 7, grid), dx
+            assert (obj.x, obj.y) == (12*main.TILE - obj.width - 2, 5*main.TILE + 3)
+
+@pytest.mark.parametrize("seed", range(4))
+def test_swept_collision_moves_or_stays_put(seed):
+    sim = main.Simulation(seed=seed)
+    rng = random.Random(seed)
+    grid = sim.rooms[0]
+    for obj in entities():
+        for _ in range(300):
+            obj.x = rng.uniform(0, main.SCREEN_WIDTH - obj.width)
+            obj.y = rng.uniform(0, main.SCREEN_HEIGHT - obj.height)
+            if main.wall_collision(obj, grid):
+                continue
+            ox, oy = obj.x, obj.y
+            dx = rng.uniform(-3*main.TILE, 3*main.TILE)
+            dy = rng.uniform(-3*main.TILE, 3*main.TILE)
+            if main.swept_collision(obj, dx, dy, grid):
+                assert (obj.x, obj.y) == (ox, oy)
+            else:
+                assert (obj.x, obj.y) == pytest.approx((ox+dx, oy+dy))
+                assert not main.wall_collision(obj, grid)
+
+# Every tile the segment touches, found exactly: the tile at each edge
+# crossing and halfway between consecutive crossings.
+def segment_tiles(x0, y0, x1, y1):
+    T = main.TILE
+    ts = {Fraction(0), Fraction(1)}
+    for a0, a1 in ((x0, x1), (y0, y1)):
+        if a0 != a1:
+            for k in range(min(a0, a1)//T, max(a0, a1)//T + 2):
+                t = Fraction(k*T - a0, a1 - a0)
+                if 0 <= t <= 1:
+                    ts.add(t)
+    ts = sorted(ts)
+    ts += [(a+b)/2 for a, b in zip(ts, ts[1:])]
+    return {(math.floor(x0 + (x1-x0)*t)//T, math.floor(y0 + (y1-y0)*t)//T) for t in ts}
+
+def segment_reference(x0, y0, x1, y1, grid):
+    return any(0 <= gx < main.ROOM_W and 0 <= gy < main.ROOM_H and grid[gy][gx] == 1
+               for gx, gy in segment_tiles(x0, y0, x1, y1))
+
+def test_segment_hits_wall_end_on_tile_corner():
+    grid = open_grid()
+    grid[0][13] = 1
+    assert main.segment_hits_wall(359, 36, 416, 0, grid)
+    assert main.segment_hits_wall(416, 0, 359, 36, grid)
+
+@pytest.mark.parametrize("seed", range(4))
+def test_segment_hits_wall_matches_exact_walk(seed):
+    rng = random.Random(seed)
+    T = main.TILE
+    grid = open_grid()
+    for gy in range(main.ROOM_H):
+        for gx in range(main.ROOM_W):
+            grid[gy][gx] = int(rng.random() < 0.2)
+    for _ in range(3000):
+        if rng.random() < 0.5:
+            # on tile corners and through them, where the walk has to break ties
+            x0 = rng.randrange(main.ROOM_W+1)*T
+            y0 = rng.randrange(main.ROOM_H+1)*T
+            x1 = x0 + rng.randint(-3, 3)*T
+            y1 = y0 + rng.randint(-3, 3)*T
+            x0 += rng.choice((0, 0, 1, -1)); y0 += rng.choice((0, 0, 1, -1))
+        else:
+            x0 = rng.randrange(main.SCREEN_WIDTH); y0 = rng.randrange(main.SCREEN_HEIGHT)
+            x1 = x0 + rng.randint(-4*T, 4*T); y1 = y0 + rng.randint(-4*T, 4*T)
+        expected = segment_reference(x0, y0, x1, y1, grid)
+        assert main.segment_hits_wall(x0, y0, x1, y1, grid) == expected, (x0, y0, x1, y1)
+        assert main.segment_hits_wall(x1, y1, x0, y0, grid) == expected, (x1, y1, x0, y0)